@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Estimate how much each image is shifted (and optionally rotated) from a
+reference image, using FFT phase correlation on small greyscale pyramids.
+The estimates are cached, so re-running on the same images is instant.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from PIL import Image
+
+# Longest side of the finest pyramid level used for estimating
+ALIGN_SIZE = 512
+# Stop halving the pyramid below this
+MIN_LEVEL_SIZE = 32
+# Angles to sample the spectrum at, over 180 degrees
+ANGLES = 360
+
+reference_pyramid = None
+
+
+def load_grey(filename, max_size=ALIGN_SIZE):
+    """Decode a small greyscale copy of an image.
+
+    Returns it as a float array, and how many full-size pixels there are
+    per small pixel.
+    """
+    with Image.open(filename) as im:
+        factor = max(1.0, max(im.size) / max_size)
+        size = (round(im.width / factor), round(im.height / factor))
+        im.draft("L", size)
+        im = im.convert("L")
+        if im.size != size:
+            im = im.resize(size, Image.Resampling.BOX)
+    return numpy.asarray(im, numpy.float32), factor
+
+
+def make_pyramid(grey):
+    # Halve the size until it's small, coarsest level first
+    levels = [grey]
+    while min(levels[-1].shape) // 2 >= MIN_LEVEL_SIZE:
+        level = levels[-1]
+        height, width = level.shape[0] // 2 * 2, level.shape[1] // 2 * 2
+        level = level[:height, :width]
+        levels.append(
+            (
+                level[0::2, 0::2]
+                + level[1::2, 0::2]
+                + level[0::2, 1::2]
+                + level[1::2, 1::2]
+            )
+            / 4
+        )
+    return levels[::-1]
+
+
+def window(shape):
+    # Taper the edges so they don't dominate the spectrum
+    return numpy.outer(numpy.hanning(shape[0]), numpy.hanning(shape[1]))
+
+
+def subpixel(values, peak):
+    # Fit a parabola through the peak and its neighbours
+    before, at, after = values[peak - 1], values[peak], values[(peak + 1) % len(values)]
+    denominator = before - 2 * at + after
+    if denominator == 0:
+        return 0.0
+    return 0.5 * (before - after) / denominator
+
+
+def phase_correlation(reference, moving, search=None):
+    """Return the (dy, dx) that moving is shifted by from reference.
+
+    search  If given, only look for a peak this many pixels from zero
+    """
+    taper = window(reference.shape)
+    cross = numpy.fft.fft2(reference * taper).conj() * numpy.fft.fft2(moving * taper)
+    cross /= numpy.abs(cross) + 1e-9
+    correlation = numpy.fft.ifft2(cross).real
+
+    if search is not None:
+        # Ignore peaks further away than the search distance
+        height, width = correlation.shape
+        dy = numpy.minimum(numpy.arange(height), height - numpy.arange(height))
+        dx = numpy.minimum(numpy.arange(width), width - numpy.arange(width))
+        far = (dy[:, None] > search) | (dx[None, :] > search)
+        correlation = numpy.where(far, -numpy.inf, correlation)
+
+    peak_y, peak_x = numpy.unravel_index(numpy.argmax(correlation), correlation.shape)
+    dy = peak_y + subpixel(correlation[:, peak_x], peak_y)
+    dx = peak_x + subpixel(correlation[peak_y, :], peak_x)
+    # Peaks past halfway are negative shifts
+    height, width = correlation.shape
+    if dy > height / 2:
+        dy -= height
+    if dx > width / 2:
+        dx -= width
+    return dy, dx
+
+
+def polar_spectrum(grey):
+    """Sample the centred magnitude spectrum at ANGLES angles over 180 degrees.
+
+    Rotating an image rotates its spectrum by the same angle, but shifting
+    it doesn't change the magnitude, so this finds rotation on its own.
+    """
+    # Frequencies are only scaled the same in x and y for a square
+    height, width = grey.shape
+    side = min(height, width)
+    top, left = (height - side) // 2, (width - side) // 2
+    grey = grey[top : top + side, left : left + side]
+    spectrum = numpy.abs(numpy.fft.fftshift(numpy.fft.fft2(grey * window(grey.shape))))
+    # Compress the range so the low frequencies don't swamp the detail
+    spectrum = numpy.log1p(spectrum)
+    centre = side // 2
+    radii = numpy.arange(centre // 8, centre)
+    angles = numpy.linspace(0, numpy.pi, ANGLES, endpoint=False)
+    ys = numpy.rint(centre - numpy.outer(numpy.sin(angles), radii)).astype(int)
+    xs = numpy.rint(centre + numpy.outer(numpy.cos(angles), radii)).astype(int)
+    return spectrum[ys, xs]
+
+
+def estimate_rotation(reference, moving):
+    # Rotation is a shift along the angle axis of the polar spectra
+    reference_polar = polar_spectrum(reference)
+    moving_polar = polar_spectrum(moving)
+    cross = numpy.fft.fft(reference_polar, axis=0).conj() * numpy.fft.fft(
+        moving_polar, axis=0
+    )
+    cross = cross.sum(axis=1)
+    cross /= numpy.abs(cross) + 1e-9
+    correlation = numpy.fft.ifft(cross).real
+    peak = int(numpy.argmax(correlation))
+    shift = peak + subpixel(correlation, peak)
+    if shift > ANGLES / 2:
+        shift -= ANGLES
+    return shift * 180 / ANGLES
+
+
+def rotate_grey(grey, angle):
+    return numpy.asarray(
+        Image.fromarray(grey).rotate(angle, resample=Image.Resampling.BILINEAR)
+    )
+
+
+def estimate_translation(reference_levels, moving):
+    # Coarse to fine: each level refines the shift found at the one before
+    moving_levels = make_pyramid(moving)
+    dy = dx = 0.0
+    for i, (reference, level) in enumerate(zip(reference_levels, moving_levels)):
+        if i > 0:
+            dy, dx = dy * 2, dx * 2
+        shifted = numpy.roll(level, (-round(dy), -round(dx)), axis=(0, 1))
+        residual_y, residual_x = phase_correlation(
+            reference, shifted, search=None if i == 0 else 4
+        )
+        dy, dx = round(dy) + residual_y, round(dx) + residual_x
+    return dy, dx
+
+
+def set_reference(pyramid):
+    global reference_pyramid
+    reference_pyramid = pyramid
+
+
+def estimate_offset(filename, rotation=False):
+    """Return the (dx, dy, angle) that undoes the image's movement.
+
+    Pass them to Image.rotate(angle, translate=(dx, dy)) on the full-size
+    image to line it up with the reference.
+    """
+    grey, factor = load_grey(filename)
+    if grey.shape != reference_pyramid[-1].shape:
+        sys.exit("\nImage is a different size: " + filename + ". Tip: use --normalise.")
+    angle = 0.0
+    if rotation:
+        angle = -estimate_rotation(reference_pyramid[-1], grey)
+        grey = rotate_grey(grey, angle)
+    dy, dx = estimate_translation(reference_pyramid, grey)
+    return -dx * factor, -dy * factor, angle
+
+
+def cache_key(filename, reference, rotation):
+    stat = os.stat(filename)
+    return json.dumps(
+        [os.path.abspath(filename), stat.st_size, stat.st_mtime, reference, rotation]
+    )
+
+
+def estimate_offsets(files, reference, rotation=False, jobs=1, cache_file=None):
+    """Estimate the offset of each file from the reference file.
+
+    Offsets are estimated in a process pool, and kept in cache_file so only
+    new or changed files are estimated next time.
+
+    Returns a dict of filename: (dx, dy, angle).
+    """
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    reference_key = os.path.abspath(reference)
+    keys = {
+        filename: cache_key(filename, reference_key, rotation) for filename in files
+    }
+    todo = [filename for filename in files if keys[filename] not in cache]
+    print("Alignment offsets cached:", len(files) - len(todo))
+    print("Alignment offsets to estimate:", len(todo))
+
+    if todo:
+        grey, factor = load_grey(reference)
+        pyramid = make_pyramid(grey)
+        if jobs > 1:
+            with ProcessPoolExecutor(
+                max_workers=jobs, initializer=set_reference, initargs=(pyramid,)
+            ) as executor:
+                results = executor.map(
+                    estimate_offset,
+                    todo,
+                    [rotation] * len(todo),
+                    chunksize=max(1, len(todo) // (jobs * 4)),
+                )
+                for filename, offset in zip(todo, results):
+                    cache[keys[filename]] = offset
+        else:
+            set_reference(pyramid)
+            for i, filename in enumerate(todo):
+                sys.stdout.write("\rAligning file " + str(i + 1) + "/" + str(len(todo)))
+                cache[keys[filename]] = estimate_offset(filename, rotation)
+            sys.stdout.write("\r\n")
+
+        if cache_file:
+            with open(cache_file, "w") as f:
+                json.dump(cache, f)
+
+    return {filename: tuple(cache[keys[filename]]) for filename in files}
+
+
+# End of file
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+Write images too big to hold in memory.
+
+An uncompressed TIFF can be laid out at full size up front and its pixels
+memory-mapped, so the image can be filled a piece at a time and is a valid
+file when done. BigTIFF is used when it won't fit in 4 GB.
+
+Or, when the image is made from the top down, a PNG or TIFF can be written a
+band of rows at a time, so only the band is in memory and a PNG is
+compressed as it goes.
+"""
+from __future__ import annotations
+
+import os
+import struct
+import zlib
+
+import numpy
+from PIL import ImageColor
+
+# TIFF field types
+SHORT = 3
+LONG = 4
+LONG8 = 16
+TYPE_FORMATS = {SHORT: "H", LONG: "I", LONG8: "Q"}
+
+ROWS_PER_STRIP = 16
+
+
+def tiff_header(width, height, rows_per_strip=ROWS_PER_STRIP, bigtiff=False):
+    """Return the header and IFD bytes for an uncompressed 8-bit RGB TIFF.
+
+    The pixel data follows immediately, as rows of strips.
+    """
+    if bigtiff:
+        header_size, entry_size, offset_type = 16, 20, LONG8
+        # Formats of: number of entries, value count, value or offset
+        number_format, count_format, value_format = "Q", "Q", "Q"
+    else:
+        header_size, entry_size, offset_type = 8, 12, LONG
+        number_format, count_format, value_format = "H", "I", "I"
+    value_size = struct.calcsize(value_format)
+
+    row_bytes = width * 3
+    number_of_strips = -(-height // rows_per_strip)
+    strip_byte_counts = [
+        min(rows_per_strip, height - i * rows_per_strip) * row_bytes
+        for i in range(number_of_strips)
+    ]
+
+    # Strip offsets depend on where the data starts, so fill them in last
+    entries = [
+        (256, LONG, [width]),  # ImageWidth
+        (257, LONG, [height]),  # ImageLength
+        (258, SHORT, [8, 8, 8]),  # BitsPerSample
+        (259, SHORT, [1]),  # Compression: none
+        (262, SHORT, [2]),  # PhotometricInterpretation: RGB
+        (273, offset_type, None),  # StripOffsets
+        (277, SHORT, [3]),  # SamplesPerPixel
+        (278, LONG, [rows_per_strip]),  # RowsPerStrip
+        (279, offset_type, strip_byte_counts),  # StripByteCounts
+        (284, SHORT, [1]),  # PlanarConfiguration: chunky
+    ]
+    extra_start = (
+        header_size
+        + struct.calcsize(number_format)
+        + len(entries) * entry_size
+        + value_size
+    )
+
+    # Values that don't fit in an entry go after the IFD
+    extra_size = 0
+    for tag, field_type, values in entries:
+        count = number_of_strips if values is None else len(values)
+        size = count * struct.calcsize(TYPE_FORMATS[field_type])
+        if size > value_size:
+            extra_size += size
+    data_start = extra_start + extra_size
+    data_start += -data_start % 16
+    offsets = [data_start]
+    for byte_count in strip_byte_counts[:-1]:
+        offsets.append(offsets[-1] + byte_count)
+
+    ifd = struct.pack("<" + number_format, len(entries))
+    extra = b""
+    for tag, field_type, values in entries:
+        if values is None:
+            values = offsets
+        packed = struct.pack("<%d%s" % (len(values), TYPE_FORMATS[field_type]), *values)
+        if len(packed) > value_size:
+            value = struct.pack("<" + value_format, extra_start + len(extra))
+            extra += packed
+        else:
+            value = packed.ljust(value_size, b"\0")
+        ifd += struct.pack("<HH" + count_format, tag, field_type, len(values))
+        ifd += value
+    ifd += struct.pack("<" + value_format, 0)  # No next IFD
+
+    if bigtiff:
+        header = b"II+\0" + struct.pack("<HHQ", 8, 0, header_size)
+    else:
+        header = b"II*\0" + struct.pack("<I", header_size)
+    return (header + ifd + extra).ljust(data_start, b"\0")
+
+
+def any_tiff_header(width, height, rows_per_strip=ROWS_PER_STRIP):
+    """tiff_header, for a BigTIFF if it won't fit in 4 GB"""
+    header = tiff_header(width, height, rows_per_strip)
+    if len(header) + width * height * 3 >= 2**32:
+        header = tiff_header(width, height, rows_per_strip, bigtiff=True)
+    return header
+
+
+def create_tiff_memmap(filename, width, height, rows_per_strip=ROWS_PER_STRIP):
+    """Create an uncompressed RGB TIFF and memory-map its pixels.
+
+    Returns a (height, width, 3) uint8 array backed by the file, initially
+    black. Assign into it, then flush() or delete it when done.
+    """
+    data_size = width * height * 3
+    header = any_tiff_header(width, height, rows_per_strip)
+    with open(filename, "wb") as f:
+        f.write(header)
+        f.truncate(len(header) + data_size)
+    return numpy.memmap(
+        filename, numpy.uint8, "r+", offset=len(header), shape=(height, width, 3)
+    )
+
+
+def is_tiff(filename):
+    """
+    >>> is_tiff("out.TIF"), is_tiff("out.jpg")
+    (True, False)
+    """
+    return os.path.splitext(filename)[1].lower() in (".tif", ".tiff")
+
+
+class TiffCanvas:
+    """Paste into it and save it like an Image, but the pixels are a
+    memory-mapped TIFF on disk, so the size is limited by disk, not memory.
+    """
+
+    def __init__(self, filename, size, colour="white"):
+        self.filename = filename
+        self.size = size
+        width, height = size
+        self.pixels = create_tiff_memmap(filename, width, height)
+        colour = ImageColor.getrgb(colour) if isinstance(colour, str) else colour
+        if colour[:3] != (0, 0, 0):
+            # A new file is already black
+            self.pixels[:] = colour[:3]
+
+    def paste(self, im, box):
+        left, upper = box[:2]
+        pixels = numpy.asarray(im.convert("RGB"))
+        height, width = pixels.shape[:2]
+        self.pixels[upper : upper + height, left : left + width] = pixels
+
+    def save(self, filename, **kwargs):
+        # The pixels are already in the file
+        if os.path.abspath(filename) != os.path.abspath(self.filename):
+            raise ValueError("TiffCanvas can only be saved to " + self.filename)
+        self.pixels.flush()
+
+
+class TiffWriter:
+    """Write an uncompressed RGB TIFF a band of rows at a time, top down"""
+
+    def __init__(self, filename, size):
+        self.size = size
+        self.rows = 0
+        self.file = open(filename, "wb")
+        self.file.write(any_tiff_header(*size))
+
+    def write(self, pixels):
+        """Write the next rows, a (rows, width, 3) uint8 array"""
+        self.file.write(pixels.tobytes())
+        self.rows += len(pixels)
+
+    def close(self):
+        self.file.close()
+        if self.rows != self.size[1]:
+            raise ValueError("Wrote %d rows of %d" % (self.rows, self.size[1]))
+
+
+class PngWriter:
+    """Write an RGB PNG a band of rows at a time, top down, compressing as it
+    goes.
+
+    Each row uses the Sub filter (the difference from the pixel to the left),
+    which compresses photos much better than no filter, and needs nothing
+    from the row above.
+    """
+
+    def __init__(self, filename, size, compress_level=6):
+        self.size = size
+        self.rows = 0
+        self.compressor = zlib.compressobj(compress_level)
+        self.file = open(filename, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        width, height = size
+        # 8-bit RGB, not interlaced
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def chunk(self, chunk_type, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type + data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def write(self, pixels):
+        """Write the next rows, a (rows, width, 3) uint8 array"""
+        rows = pixels.reshape(len(pixels), -1)
+        filtered = numpy.empty((len(rows), rows.shape[1] + 1), numpy.uint8)
+        filtered[:, 0] = 1  # Sub
+        filtered[:, 1:4] = rows[:, :3]
+        numpy.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.chunk(b"IDAT", data)
+        self.rows += len(pixels)
+
+    def close(self):
+        self.chunk(b"IDAT", self.compressor.flush())
+        self.chunk(b"IEND", b"")
+        self.file.close()
+        if self.rows != self.size[1]:
+            raise ValueError("Wrote %d rows of %d" % (self.rows, self.size[1]))
+
+
+class StreamingCanvas:
+    """Paste into it and save it like an Image, but the pastes must go down
+    the image. Rows are written to a PNG or TIFF (or to writer, with write()
+    and close() like PngWriter) once a paste starts below them, so only the
+    rows since then are in memory.
+    """
+
+    def __init__(self, filename, size, colour="white", writer=None):
+        self.filename = filename
+        self.size = size
+        if writer:
+            self.writer = writer
+        elif is_tiff(filename):
+            self.writer = TiffWriter(filename, size)
+        else:
+            self.writer = PngWriter(filename, size)
+        colour = ImageColor.getrgb(colour) if isinstance(colour, str) else colour
+        self.colour = numpy.array(colour[:3], numpy.uint8)
+        self.top = 0  # The first row not yet written
+        self.band = numpy.empty((0, size[0], 3), numpy.uint8)
+
+    def blank(self, rows):
+        return numpy.broadcast_to(self.colour, (rows, self.size[0], 3))
+
+    def flush(self, row):
+        """Write all the rows above this one"""
+        written = min(len(self.band), row - self.top)
+        if written > 0:
+            self.writer.write(self.band[:written])
+            self.band = self.band[written:]
+            self.top += written
+        while self.top < row:
+            # Nothing was pasted here, so write the background a strip at a time
+            rows = min(row - self.top, ROWS_PER_STRIP)
+            self.writer.write(self.blank(rows))
+            self.top += rows
+
+    def paste(self, im, box):
+        left, upper = box[:2]
+        if upper < self.top:
+            raise ValueError("Can't paste above row %d, already written" % self.top)
+        self.flush(upper)
+        pixels = numpy.asarray(im.convert("RGB"))
+        height, width = pixels.shape[:2]
+        lower = upper + height - self.top
+        if lower > len(self.band):
+            self.band = numpy.concatenate(
+                [self.band, self.blank(lower - len(self.band))]
+            )
+        self.band[upper - self.top : lower, left : left + width] = pixels
+
+    def save(self, filename, **kwargs):
+        # The pixels are already in the file, apart from the last rows
+        if os.path.abspath(filename) != os.path.abspath(self.filename):
+            raise ValueError("StreamingCanvas can only be saved to " + self.filename)
+        self.flush(self.size[1])
+        self.writer.close()
+
+
+# End of file
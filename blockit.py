@@ -7,6 +7,7 @@ Can do a grid of squares or rectangles, or vertical or horizontal stripes.
 from __future__ import annotations
 
 import argparse
+import itertools
 import random
 import sys
 from operator import itemgetter
@@ -14,6 +15,7 @@ from operator import itemgetter
 from PIL import Image
 
 import fileutils
+import region_reader
 
 
 def save_im(im):
@@ -166,45 +168,48 @@ if __name__ == "__main__":
     # Create new blank image
     new_image = Image.new("RGB", (args.outwidth, args.outheight))
 
-    # Now open each image in turn and get the blocks
-    open_index = -1
-    open_im = ""
+    # Now open each image in turn and get all its blocks at once
     done = 0
     width, height = 0, 0
-    for index, block_number in random_indices:
-        # print(open_index, index)
-
-        if open_index != index:
-            open_index = index
-            sys.stdout.write(
-                "\rBlocks done: "
-                + str(done)
-                + "/"
-                + str(number_of_blocks)
-                + ". Getting blocks from file "
-                + str(index)
-            )
-            try:
-                open_im = Image.open(files[open_index])
-            except Exception:
-                print("Problem with file", files[open_index])
-                continue
-
-        rand_x = get_rand_point(open_im.size[0], args.blockwidth)
-        rand_y = get_rand_point(open_im.size[1], args.blockheight)
-        crop_box = (rand_x, rand_y, rand_x + args.blockwidth, rand_y + args.blockheight)
-
-        crop_im = open_im.crop(crop_box)
-        height, width = divmod(block_number, args.outwidth / args.blockwidth)
-        width *= args.blockwidth
-        height *= args.blockheight
-        new_image.paste(crop_im, (int(width), int(height)))
-        width += args.blockwidth
-        if (width + args.blockwidth) > args.outwidth:
-            width = 0
-            height += args.blockheight
-        done += 1
+    for index, group in itertools.groupby(random_indices, key=itemgetter(0)):
+        block_numbers = [block_number for _, block_number in group]
+        sys.stdout.write(
+            "\rBlocks done: "
+            + str(done)
+            + "/"
+            + str(number_of_blocks)
+            + ". Getting blocks from file "
+            + str(index)
+        )
+        try:
+            with Image.open(files[index]) as open_im:
+                size = open_im.size
+            crop_boxes = []
+            for block_number in block_numbers:
+                rand_x = get_rand_point(size[0], args.blockwidth)
+                rand_y = get_rand_point(size[1], args.blockheight)
+                crop_boxes.append(
+                    (
+                        rand_x,
+                        rand_y,
+                        rand_x + args.blockwidth,
+                        rand_y + args.blockheight,
+                    )
+                )
+            # Only decodes as much of the image as the blocks need
+            blocks = region_reader.read_regions(files[index], crop_boxes)
+        except Exception:
+            print("Problem with file", files[index])
+            continue
+
+        for block_number, block in zip(block_numbers, blocks):
+            height, width = divmod(block_number, args.outwidth / args.blockwidth)
+            width *= args.blockwidth
+            height *= args.blockheight
+            new_image.paste(Image.fromarray(block), (int(width), int(height)))
+            done += 1
     sys.stdout.write("\r\n")
+    region_reader.report()
 
     print("Done:", done, "/", number_of_blocks)
     # We have all the random blocks, save them
@@ -11,13 +11,21 @@ from __future__ import annotations
 
 import argparse
 import glob
+import hashlib
+import json
 import os
 import random
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-from PIL import Image
+from PIL import Image, ImageOps
 
+import bigimage
+import deepzoom
 import factors
+import thumbnails
 
 # PIL jpeg saving: Maximum supported image dimension is 65500 pixels
 MAX_DIMENSION = 65500
@@ -73,6 +81,147 @@ def aspect_ratio(number, thumbsize, aspect_ratio):
     return cols, rows
 
 
+def thumbnail_key(fname, size, thumbnail=False, flip=False):
+    """
+    A hash of the file's path, size, mtime and inode and how it's thumbnailed,
+    which changes when the thumbnail would. None if the file isn't there.
+    """
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    key = json.dumps(
+        [
+            os.path.abspath(fname),
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+            list(size),
+            thumbnail,
+            flip,
+            thumbnails.REDUCING_GAP,
+        ]
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class ThumbnailCache:
+    """Keep thumbnails on disk between runs, within a byte budget.
+
+    Each thumbnail is kept as a PNG, in a file named by its thumbnail_key, so
+    changing the source or the thumbnail options makes a new one.
+
+    Using a thumbnail touches its file. As each new one is written, the least
+    recently used are deleted until the cache fits in the budget again, apart
+    from those still to be read this run.
+    """
+
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        # Path: bytes, least recently used first
+        self.sizes = {}
+        entries = sorted(
+            (entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+            for entry in os.scandir(directory)
+            if entry.name.endswith(".png")
+        )
+        for _, size, path in entries:
+            self.sizes[path] = size
+        self.total = sum(self.sizes.values())
+
+    def path(self, fname, size, thumbnail, flip):
+        key = thumbnail_key(fname, size, thumbnail, flip)
+        if key is None:
+            return None
+        return os.path.join(self.directory, key + ".png")
+
+    def lookup(self, fnames, size, thumbnail=False, flip=False):
+        """Returns the cache file for each image, and whether each is there"""
+        paths = [self.path(fname, size, thumbnail, flip) for fname in fnames]
+        hits = [path is not None and os.path.exists(path) for path in paths]
+        return paths, hits
+
+    def used(self, path):
+        # Now the most recently used
+        self.total -= self.sizes.pop(path, 0)
+        self.sizes[path] = os.path.getsize(path)
+        self.total += self.sizes[path]
+
+    def thumbnails(self, paths, hits, made, size):
+        """
+        Yield (RGB bytes, error) for each image in order, reading the hits from
+        disk and taking the misses from made, which are then kept for next time
+        """
+        to_read = {path for path, hit in zip(paths, hits) if hit}
+        for path, hit in zip(paths, hits):
+            if hit:
+                self.hits += 1
+                to_read.discard(path)
+                with Image.open(path) as im:
+                    data = im.tobytes()
+                # Most recently used, finer grained than os.utime(path) can be
+                now = time.time_ns()
+                os.utime(path, ns=(now, now))
+                self.used(path)
+                yield data, None
+                continue
+            self.misses += 1
+            data, error = next(made)
+            if data is not None and path is not None:
+                # Written whole or not at all
+                Image.frombytes("RGB", size, data).save(path + ".tmp", "PNG")
+                os.replace(path + ".tmp", path)
+                self.used(path)
+                self.evict(keep=to_read)
+            yield data, error
+
+    def evict(self, keep=()):
+        """Delete the least recently used, apart from keep, until it fits"""
+        victims = []
+        for path in self.sizes:
+            if self.total <= self.max_bytes:
+                break
+            if path not in keep:
+                victims.append(path)
+                self.total -= self.sizes[path]
+        for path in victims:
+            del self.sizes[path]
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already evicted by another run
+                pass
+
+    def report(self):
+        lookups = self.hits + self.misses
+        print("Cache hits:\t", self.hits, "/", lookups)
+        print("Cache misses:\t", self.misses, "/", lookups)
+        print(
+            "Cache size:\t %.1f MB in %d files"
+            % (self.total / (1024 * 1024), len(self.sizes))
+        )
+
+
+def make_thumbnail(fname, size, thumbnail=False, flip=False):
+    """
+    Read in an image and resize it to exactly size (w, h).
+
+    Returns (RGB bytes, None), or (None, error) when the image can't be read,
+    so a bad file only leaves its own cell empty.
+    """
+    try:
+        with Image.open(fname) as img:
+            img = thumbnails.resize(img, size, crop=thumbnail)
+        if flip:
+            img = ImageOps.mirror(img)
+        return img.convert("RGB").tobytes(), None
+    except Exception as e:
+        return None, repr(e)
+
+
 def make_contact_sheet(
     fnames,
     ncols_nrows,
@@ -82,6 +231,11 @@ def make_contact_sheet(
     bgcolour="white",
     thumbnail=False,
     flip=False,
+    outfile=None,
+    jobs=1,
+    cache=None,
+    stream=False,
+    quality=90,
 ):
     """
     Make a contact sheet from a group of filenames:
@@ -103,8 +257,18 @@ def make_contact_sheet(
     bgcolour     Background colour
     thumbnail    Thumbnail/crop images instead of resizing
     flip         Flip the images left-to-right
-
-    returns a PIL image object.
+    outfile      If a TIFF, make the sheet straight into it on disk, so it
+                 can be bigger than memory and JPEG allow. If a .dzi, make
+                 it a Deep Zoom pyramid of tiles, only remaking the tiles
+                 whose images changed since last time.
+    jobs         Number of worker processes making thumbnails
+    cache        A ThumbnailCache, so only thumbnails not made before are made
+    stream       Write outfile (a PNG or TIFF) a row of thumbnails at a time,
+                 so only one row is in memory
+    quality      JPEG quality of Deep Zoom tiles
+
+    returns a PIL image object, or a bigimage.TiffCanvas or StreamingCanvas,
+    or a deepzoom.Pyramid.
     """
     ncols, nrows = ncols_nrows
     photow, photoh = photow_photoh
@@ -121,61 +285,95 @@ def make_contact_sheet(
     padh = (nrows - 1) * padding
     isize = (int(ncols * photow + marw + padw), int(nrows * photoh + marh + padh))
 
+    tiff = outfile is not None and bigimage.is_tiff(outfile)
+    dzi = outfile is not None and deepzoom.is_dzi(outfile)
+    big = tiff or stream or dzi
+
     print("Image size:", isize)
-    if isize[0] > MAX_DIMENSION:
+    if isize[0] > MAX_DIMENSION and not big:
         sys.exit(
             "Output image is too wide: "
             + str(isize[0])
             + " (Max: "
             + str(MAX_DIMENSION)
             + "). Tip: use --thumbsize "
-            "(or --half or --quarter)."
+            "(or --half or --quarter), or save as .tif, or --stream."
         )
-    if isize[1] > MAX_DIMENSION:
+    if isize[1] > MAX_DIMENSION and not big:
         sys.exit(
             "Output image is too high: "
             + str(isize[1])
             + " (Max: "
             + str(MAX_DIMENSION)
             + "). Tip: use --thumbsize "
-            "(or --half or --quarter)."
+            "(or --half or --quarter), or save as .tif, or --stream."
         )
 
-    # Create the new image
-    inew = Image.new("RGB", isize, bgcolour)
+    cells = fnames[: ncols * nrows]
+    size = (photow, photoh)
+    boxes = []
+    for irow in range(nrows):
+        for icol in range(ncols):
+            left = marl + icol * (photow + padding)
+            upper = mart + irow * (photoh + padding)
+            boxes.append((left, upper, left + photow, upper + photoh))
 
-    if thumbnail or flip:
-        from PIL import ImageOps
+    # Create the new image
+    if dzi:
+        keys = [thumbnail_key(fname, size, thumbnail, flip) for fname in cells]
+        keys += [None] * (len(boxes) - len(cells))
+        inew = deepzoom.Pyramid(outfile, isize, bgcolour, boxes, keys, quality, jobs)
+    elif stream:
+        inew = bigimage.StreamingCanvas(outfile, isize, bgcolour)
+    elif tiff:
+        inew = bigimage.TiffCanvas(outfile, isize, bgcolour)
+    else:
+        inew = Image.new("RGB", isize, bgcolour)
+
+    if dzi:
+        # Only the images in tiles to be made
+        indexes = [i for i in range(len(cells)) if inew.needed(boxes[i])]
+        cells = [cells[i] for i in indexes]
+    else:
+        indexes = range(len(cells))
+    if cache:
+        paths, hits = cache.lookup(cells, size, thumbnail, flip)
+        todo = [fname for fname, hit in zip(cells, hits) if not hit]
+    else:
+        todo = cells
+    if jobs > 1 and todo:
+        print("Workers:\t", jobs)
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        # Made in parallel, but returned in grid order
+        thumbs = executor.map(
+            make_thumbnail,
+            todo,
+            repeat(size),
+            repeat(thumbnail),
+            repeat(flip),
+            chunksize=max(1, len(todo) // (jobs * 4)),
+        )
+    else:
+        executor = None
+        thumbs = (make_thumbnail(fname, size, thumbnail, flip) for fname in todo)
+    if cache:
+        thumbs = cache.thumbnails(paths, hits, thumbs, size)
 
-    count = 0
     # Insert each thumb:
-    for irow in range(nrows):
-        for icol in range(ncols):
+    try:
+        for count, (data, error) in enumerate(thumbs):
             sys.stdout.write(
-                "\rProcessing file " + str(count + 1) + "/" + str(len(fnames))
+                "\rProcessing file " + str(count + 1) + "/" + str(len(cells))
             )
-            left = marl + icol * (photow + padding)
-            right = left + photow
-            upper = mart + irow * (photoh + padding)
-            lower = upper + photoh
-            bbox = (left, upper, right, lower)
-            try:
-                # Read in an image and resize appropriately
-                img = Image.open(fnames[count])
-                if thumbnail:
-                    img = ImageOps.fit(img, (photow, photoh), Image.Resampling.LANCZOS)
-                else:
-                    img = img.resize((photow, photoh), Image.Resampling.LANCZOS)
-                if flip:
-                    img = ImageOps.mirror(img)
-            except KeyboardInterrupt:
-                sys.exit("Keyboard interrupt")
-            except Exception as e:
-                print("Error: %s" % repr(e))
-                break
-            inew.paste(img, bbox)
-            count += 1
+            if error:
+                print("\nError: %s: %s" % (cells[count], error))
+                continue
+            inew.paste(Image.frombytes("RGB", size, data), boxes[indexes[count]])
+    except KeyboardInterrupt:
+        sys.exit("Keyboard interrupt")
     sys.stdout.write("\r\n")
+    if executor:
+        executor.shutdown()
     return inew
 
 
@@ -194,6 +392,9 @@ def make(
     bgcolour="white",
     thumbnail=False,
     flip=False,
+    jobs=1,
+    cache=None,
+    stream=False,
 ):
     ncols, nrows = ncols_nrows
     files = sorted(glob.glob(inspec))
@@ -238,10 +439,26 @@ def make(
 
     print("Making contact sheet")
     inew = make_contact_sheet(
-        files, (ncols, nrows), thumbsize, margins, padding, bgcolour, thumbnail, flip
+        files,
+        (ncols, nrows),
+        thumbsize,
+        margins,
+        padding,
+        bgcolour,
+        thumbnail,
+        flip,
+        outfile,
+        jobs,
+        cache,
+        stream,
+        quality,
     )
     print("Saving to", outfile)
     inew.save(outfile, quality=quality)
+    if cache:
+        # In case --cache-mb is smaller than last time
+        cache.evict()
+        cache.report()
     print("Done.")
     # inew.show()
 
@@ -268,7 +485,11 @@ if __name__ == "__main__":
         "-f", "--flip", action="store_true", help="Flip input images left-to-right"
     )
     parser.add_argument(
-        "-o", "--outfile", default="contact_sheet.jpg", help="Output filename"
+        "-o",
+        "--outfile",
+        default="contact_sheet.jpg",
+        help="Output filename. Use .tif for sheets too big for memory, or .dzi "
+        "for a Deep Zoom pyramid of tiles to pan and zoom in a browser.",
     )
     parser.add_argument("-r", "--rows", type=int, help="Number of rows")
     parser.add_argument("-c", "--cols", type=int, help="Number of columns")
@@ -310,6 +531,32 @@ if __name__ == "__main__":
     parser.add_argument(
         "-q", "--quality", default=90, type=int, help="Output image's save quality"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes making thumbnails in parallel. "
+        "Use 0 for all CPUs.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep thumbnails in this directory, so re-making a sheet of the "
+        "same images at the same --thumbsize only reads the thumbnails",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=1024,
+        help="For --cache-dir: Delete the least recently used thumbnails to "
+        "keep the cache within this many MB",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write the sheet a row of thumbnails at a time, so only one row "
+        "is in memory. For .png and .tif outfiles.",
+    )
     parser.add_argument(
         "-nc",
         "--noclobber",
@@ -325,10 +572,22 @@ if __name__ == "__main__":
     except ImportError:
         pass
     print(args)
+    if args.jobs == 0:
+        args.jobs = os.cpu_count()
 
     if args.noclobber and os.path.exists(args.outfile):
         sys.exit("Output file (" + args.outfile + ") already exists, exiting")
 
+    if args.stream and not (
+        bigimage.is_tiff(args.outfile) or args.outfile.lower().endswith(".png")
+    ):
+        sys.exit("--stream needs a .png or .tif outfile")
+
+    if args.cache_dir:
+        cache = ThumbnailCache(args.cache_dir, args.cache_mb * 1024 * 1024)
+    else:
+        cache = None
+
     make(
         (args.cols, args.rows),
         args.inspec,
@@ -344,6 +603,9 @@ if __name__ == "__main__":
         args.bgcolour,
         args.thumbnail,
         args.flip,
+        args.jobs,
+        cache,
+        args.stream,
     )
 
 # End of file
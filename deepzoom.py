@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Write images as Deep Zoom pyramids, which a browser viewer such as
+OpenSeadragon can pan and zoom without loading the whole image.
+
+name.dzi describes the image, and the tiles are in
+name_files/<level>/<column>_<row>.jpg. The last level is full size, and each
+level before it is half the size of the next, down to 1x1 pixels.
+
+The full size level is cut from rows pasted top down (see
+bigimage.StreamingCanvas), and each other level is made from the four tiles
+below it, so the image is never all in memory.
+
+A manifest remembers what was pasted where, so when the same image is made
+again only the tiles whose contents changed are made, and those above them.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from PIL import Image
+
+import bigimage
+
+TILE_SIZE = 256
+
+DZI = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  Format="jpg" Overlap="0" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+
+def is_dzi(filename):
+    """
+    >>> is_dzi("out.dzi"), is_dzi("out.jpg")
+    (True, False)
+    """
+    return os.path.splitext(filename)[1].lower() == ".dzi"
+
+
+def level_sizes(width, height):
+    """
+    The size of each level, from 1x1 up to full size
+
+    >>> level_sizes(5, 3)
+    [(1, 1), (2, 1), (3, 2), (5, 3)]
+    """
+    sizes = [(width, height)]
+    while sizes[0] != (1, 1):
+        width, height = sizes[0]
+        sizes.insert(0, ((width + 1) // 2, (height + 1) // 2))
+    return sizes
+
+
+def tiles_in(box, tile_size=TILE_SIZE):
+    """
+    The (column, row) of each tile the box overlaps
+
+    >>> sorted(tiles_in((250, 0, 300, 10)))
+    [(0, 0), (1, 0)]
+    """
+    left, upper, right, lower = box
+    return {
+        (column, row)
+        for column in range(left // tile_size, (right - 1) // tile_size + 1)
+        for row in range(upper // tile_size, (lower - 1) // tile_size + 1)
+    }
+
+
+def make_tile(directory, level, column, row, below_size, quality=90):
+    """
+    Make a tile by halving the (up to) four tiles below it, which together
+    are below_size
+    """
+    width, height = below_size
+    below = Image.new("RGB", below_size)
+    for y in range(0, height, TILE_SIZE):
+        for x in range(0, width, TILE_SIZE):
+            filename = os.path.join(
+                directory,
+                str(level + 1),
+                "%d_%d.jpg" % (column * 2 + x // TILE_SIZE, row * 2 + y // TILE_SIZE),
+            )
+            with Image.open(filename) as im:
+                below.paste(im, (x, y))
+    below.reduce(2).save(
+        os.path.join(directory, str(level), "%d_%d.jpg" % (column, row)),
+        quality=quality,
+    )
+
+
+class BaseTiles:
+    """Cut rows written top down into the tiles of the full size level, and
+    save the dirty ones"""
+
+    def __init__(self, directory, size, dirty, quality=90):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.columns = -(-size[0] // TILE_SIZE)
+        self.dirty = dirty
+        self.quality = quality
+        self.row = 0
+        self.band = numpy.empty((0, size[0], 3), numpy.uint8)
+
+    def write(self, pixels):
+        self.band = numpy.concatenate([self.band, pixels])
+        while len(self.band) >= TILE_SIZE:
+            self.save_row(self.band[:TILE_SIZE])
+            self.band = self.band[TILE_SIZE:]
+
+    def save_row(self, band):
+        for column in range(self.columns):
+            if (column, self.row) in self.dirty:
+                tile = band[:, column * TILE_SIZE : (column + 1) * TILE_SIZE]
+                Image.fromarray(numpy.ascontiguousarray(tile)).save(
+                    os.path.join(self.directory, "%d_%d.jpg" % (column, self.row)),
+                    quality=self.quality,
+                )
+        self.row += 1
+
+    def close(self):
+        if len(self.band):
+            self.save_row(self.band)
+
+
+class Pyramid:
+    """Paste into it top down and save it like an Image, but it's saved as a
+    Deep Zoom pyramid.
+
+    boxes are where things will be pasted, and keys say what they are (None
+    for nothing). Tiles are only made where the keys are different from last
+    time, so check needed(box) before making something to paste there.
+    """
+
+    def __init__(self, filename, size, colour, boxes, keys, quality=90, jobs=1):
+        self.filename = filename
+        self.size = size
+        self.quality = quality
+        self.jobs = jobs
+        self.directory = os.path.splitext(filename)[0] + "_files"
+        self.manifest_file = os.path.join(self.directory, "manifest.json")
+        # Round trip so tuples are lists, like the saved one
+        self.manifest = json.loads(
+            json.dumps(
+                {
+                    "size": size,
+                    "colour": colour,
+                    "tile_size": TILE_SIZE,
+                    "quality": quality,
+                    "boxes": boxes,
+                    "keys": keys,
+                }
+            )
+        )
+        old = None
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                old = json.load(f)
+            # Tiles are about to change, so if this run is interrupted, the
+            # next has no manifest to trust and redoes them all
+            os.remove(self.manifest_file)
+
+        self.levels = level_sizes(*size)
+        base = len(self.levels) - 1
+        if old and all(
+            old[name] == self.manifest[name]
+            for name in ("size", "colour", "tile_size", "quality", "boxes")
+        ):
+            self.dirty = set()
+            for box, key, old_key in zip(boxes, keys, old["keys"]):
+                if key != old_key:
+                    self.dirty |= tiles_in(box)
+        else:
+            # Start again
+            if os.path.isdir(self.directory):
+                shutil.rmtree(self.directory)
+            self.dirty = tiles_in((0, 0) + tuple(size))
+        print("Tiles to make:\t", len(self.dirty))
+
+        self.canvas = bigimage.StreamingCanvas(
+            filename,
+            size,
+            colour,
+            writer=BaseTiles(
+                os.path.join(self.directory, str(base)), size, self.dirty, quality
+            ),
+        )
+
+    def needed(self, box):
+        """Whether anything pasted in this box will be seen"""
+        return not self.dirty.isdisjoint(tiles_in(box))
+
+    def paste(self, im, box):
+        self.canvas.paste(im, box)
+
+    def save(self, filename, **kwargs):
+        # The full size level is already mostly saved
+        self.canvas.save(filename)
+
+        dirty = self.dirty
+        executor = ProcessPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        for level in range(len(self.levels) - 2, -1, -1):
+            sys.stdout.write("\rMaking level " + str(level))
+            os.makedirs(os.path.join(self.directory, str(level)), exist_ok=True)
+            dirty = {(column // 2, row // 2) for column, row in dirty}
+            width, height = self.levels[level + 1]
+            tiles = sorted(dirty)
+            below_sizes = [
+                (
+                    min(2 * TILE_SIZE, width - column * 2 * TILE_SIZE),
+                    min(2 * TILE_SIZE, height - row * 2 * TILE_SIZE),
+                )
+                for column, row in tiles
+            ]
+            args = (
+                [self.directory] * len(tiles),
+                [level] * len(tiles),
+                [column for column, row in tiles],
+                [row for column, row in tiles],
+                below_sizes,
+                [self.quality] * len(tiles),
+            )
+            if executor:
+                list(executor.map(make_tile, *args))
+            else:
+                list(map(make_tile, *args))
+        sys.stdout.write("\r\n")
+        if executor:
+            executor.shutdown()
+
+        with open(self.filename, "w") as f:
+            f.write(
+                DZI.format(tile_size=TILE_SIZE, width=self.size[0], height=self.size[1])
+            )
+        # Last, once every tile matches it
+        with open(self.manifest_file, "w") as f:
+            json.dump(self.manifest, f)
+
+
+# End of file
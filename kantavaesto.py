@@ -12,6 +12,8 @@ import sys
 
 from PIL import Image
 
+import region_reader
+
 
 def kantavaesto(inspec, outfile):
 
@@ -43,11 +45,12 @@ def kantavaesto(inspec, outfile):
         if last_bbox != bbox:
             last_bbox = bbox
             print(bbox)
-            next_im = Image.open(f).crop(bbox)
+            next_im = Image.fromarray(region_reader.read_region(f, bbox))
             # next_im.show()
             im.paste(next_im, bbox)
             # im.show()
 
+    region_reader.report()
     # im.show()
     print("Saving to", outfile)
     im.save(outfile, quality=95)
@@ -8,7 +8,9 @@ import glob
 import os
 import shutil
 
-from PIL import Image, ImageOps
+from PIL import Image
+
+import thumbnails
 
 
 def mean(values):
@@ -113,9 +115,9 @@ def normalise_files(spec, files, normalise, temp_dir):
             temp_file = os.path.join(temp_dir, filename)
 
             try:
-                im = Image.open(f)
-                # im = im.resize(size)
-                im = ImageOps.fit(im, size, Image.Resampling.LANCZOS)
+                with Image.open(f) as im:
+                    # im = im.resize(size)
+                    im = thumbnails.resize(im, size, crop=True)
                 im.save(temp_file, quality=95)
             except Exception as e:
                 print("Ignoring problem file:", filename)
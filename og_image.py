@@ -10,6 +10,8 @@ import argparse
 
 from PIL import Image, ImageDraw, ImageFont
 
+import thumbnails
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(
@@ -56,7 +58,11 @@ def main() -> None:
     im = Image.new("RGBA", (args.width, args.height))
 
     with Image.open(args.logo) as logo:
-        logo.thumbnail((logo_height, logo_height), resample=Image.Resampling.LANCZOS)
+        logo.thumbnail(
+            (logo_height, logo_height),
+            resample=Image.Resampling.LANCZOS,
+            reducing_gap=thumbnails.REDUCING_GAP,
+        )
         im.paste(logo, (args.logo_padding_width, args.logo_padding_height))
 
     draw = ImageDraw.Draw(im)
@@ -5,7 +5,8 @@ input images. If images are not the same size, they can be normalised first.
 If there are many images to average, ImageMagick uses a lot of RAM causing
 very slow paging. To counter this, average in (preferably equal-sized)
 batches, which creates temp averages from a smaller number and
-then averages those.
+then averages those. Or use the NumPy engine, which adds each image into
+a single accumulator so only one image is in memory at a time.
 """
 from __future__ import annotations
 
@@ -13,14 +14,20 @@ import argparse
 import datetime
 import glob
 import os
-import random
 import shutil
 import sys
-from operator import itemgetter
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import groupby, islice
 
+import numpy
 from PIL import Image
 
+import align
+import bigimage
 import normalise
+import region_reader
+import videoutils
 
 # Optional, http://stackoverflow.com/a/1557906/724176
 try:
@@ -31,14 +38,24 @@ except ImportError:
     pass
 
 # From a bunch of images, make a composite from average or random pixels
-# Python dependencies: Python Imaging Library (PIL)
-# External dependencies: ImageMagick's magick
+# Python dependencies: Python Imaging Library (PIL), NumPy
+# External dependencies: ImageMagick's magick (for --engine magick)
 
 TEMP_DIR = "temp"
 TEMP_PREFIX = "tmp"
 TEMP_SUFFIX = ".png"
 temp_dirs = []
 
+# Per-pixel sums of 8-bit channels: enough for 16,843,009 images
+ACCUMULATOR_DTYPE = numpy.uint32
+
+# Tiles made together from one read of each image, so memory is this many
+# tiles however wide the image is
+TILES_PER_READ = 4
+
+# filename: (dx, dy, angle) to line each image up with the reference
+frame_offsets = {}
+
 
 def encode_time():
     # Return a short, unique-ish string for creating a temp dir
@@ -162,46 +179,574 @@ def create_average_in_batches(inspec):
     )
 
 
-def create_randomised_image(files):
+def set_frame_offsets(offsets):
+    global frame_offsets
+    frame_offsets = offsets
+
+
+def load_frame(filename, scale=1):
+    # Decode an image into an RGB array, optionally reduced in size
+    with Image.open(filename) as im:
+        if scale > 1:
+            size = (im.width // scale, im.height // scale)
+            # JPEGs can be decoded at 1/2, 1/4 or 1/8 size, which is much faster
+            im.draft("RGB", size)
+            if im.size != size:
+                im = im.resize(size, Image.Resampling.BOX)
+        im = im.convert("RGB")
+        if filename in frame_offsets:
+            # Warp to line up with the reference image
+            dx, dy, angle = frame_offsets[filename]
+            im = im.rotate(
+                angle,
+                resample=Image.Resampling.BILINEAR,
+                translate=(dx / scale, dy / scale),
+            )
+        return numpy.asarray(im)
+
+
+def iter_frames(files, scale=1, progress=True):
+    # Decode the images one at a time
+    for i, filename in enumerate(files):
+        if progress:
+            sys.stdout.write("\rProcessing file " + str(i + 1) + "/" + str(len(files)))
+        yield load_frame(filename, scale)
+    if progress:
+        sys.stdout.write("\r\n")
+
+
+def get_frames(inspec, scale=1):
+    # Frames decoded from a video, or from image files in filename order
+    if videoutils.is_video(inspec):
+        return videoutils.read_frames(
+            inspec, args.start, args.duration, args.nth, scale
+        )
+    return iter_frames(sorted(get_file_list(inspec)), scale)
+
+
+def add_frames(frames):
+    """Add the frames into one accumulator.
+
+    Only one decoded frame and the accumulator are held in memory, however
+    many frames there are. Returns the per-pixel sum and the number of frames.
+    """
+    total, count = None, 0
+    for frame in frames:
+        if total is None:
+            total = numpy.zeros(frame.shape, ACCUMULATOR_DTYPE)
+        elif frame.shape != total.shape:
+            sys.exit("\nImages are different sizes. Tip: use --normalise.")
+        total += frame
+        count += 1
+    return total, count
+
+
+def sum_frames(files, progress=True, scale=1):
+    # Add the image files into one accumulator
+    return add_frames(iter_frames(files, scale, progress))
+
+
+def merge_sums(partials):
+    """Combine (sum, count) pairs from disjoint sets of images.
+
+    Sums are exact, so unequal batch sizes are weighted correctly.
+    """
+    total, count = None, 0
+    for part_total, part_count in partials:
+        if total is None:
+            total = part_total
+        elif part_total.shape != total.shape:
+            sys.exit("Images are different sizes. Tip: use --normalise.")
+        else:
+            total += part_total
+        count += part_count
+    return total, count
+
+
+def split_into_batches(files, batch_size):
+    """
+    >>> split_into_batches(["a", "b", "c", "d", "e"], 2)
+    [['a', 'b'], ['c', 'd'], ['e']]
+    """
+    return [files[i : i + batch_size] for i in range(0, len(files), batch_size)]
+
+
+def sum_frames_in_parallel(files, jobs, batch_size=None, scale=1):
+    """Sum disjoint batches of images in a process pool, then reduce them.
+
+    Each worker holds one image and one accumulator. The parent adds each
+    partial sum into its own as soon as the worker returns it, and only
+    submits a couple of batches per worker at a time, so it holds only a few
+    partial sums however many batches there are.
+    """
+    if not batch_size:
+        # A few batches per worker to balance the load
+        batch_size = max(1, -(-len(files) // (jobs * 4)))
+    batches = split_into_batches(files, batch_size)
+    print("Workers:", jobs)
+    print("Number of batches:", len(batches))
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=set_frame_offsets, initargs=(frame_offsets,)
+    ) as executor:
+
+        def completed():
+            todo = iter(batches)
+            pending = set()
+            done = 0
+            while True:
+                for batch in islice(todo, 2 * jobs - len(pending)):
+                    pending.add(
+                        executor.submit(sum_frames, batch, progress=False, scale=scale)
+                    )
+                if not pending:
+                    return
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                while finished:
+                    # Dropped once merged, so its partial sum can be freed
+                    future = finished.pop()
+                    done += 1
+                    sys.stdout.write(
+                        "\rBatches done: " + str(done) + "/" + str(len(batches))
+                    )
+                    yield future.result()
+                    del future
+
+        total, count = merge_sums(completed())
+    sys.stdout.write("\r\n")
+    return total, count
+
+
+def average_from_sum(total, count):
+    """Divide the sum by the count, rounding to nearest.
+
+    >>> total = numpy.array([0, 5, 6, 765], ACCUMULATOR_DTYPE)
+    >>> average_from_sum(total, 3).tolist()
+    [0, 2, 2, 255]
+    """
+    return ((total + count // 2) // count).astype(numpy.uint8)
+
+
+def state_filename(outfile):
+    """The running state is saved next to the output.
+
+    >>> state_filename("out-average.jpg")
+    'out-average.npz'
+    """
+    return os.path.splitext(outfile)[0] + ".npz"
+
+
+def save_state(filename, total, count, files):
+    """Save the per-pixel sum, image count and which images are included.
+
+    Written to a temp file first, so a crash never leaves a broken state.
+    """
+    temp_file = filename + ".tmp"
+    with open(temp_file, "wb") as f:
+        numpy.savez_compressed(
+            f, total=total, count=count, files=numpy.array(sorted(files), dtype=str)
+        )
+    os.replace(temp_file, filename)
+
+
+def load_state(filename):
+    with numpy.load(filename) as state:
+        return state["total"], int(state["count"]), set(state["files"].tolist())
+
+
+def merge_states(filenames):
+    """Combine saved states, without reading any images"""
+    total, count, files = None, 0, set()
+    for filename in filenames:
+        print("Load state:", filename)
+        part_total, part_count, part_files = load_state(filename)
+        overlap = files & part_files
+        if overlap:
+            sys.exit(
+                str(len(overlap))
+                + " images are already in another state, e.g. "
+                + sorted(overlap)[0]
+            )
+        files |= part_files
+        total, count = merge_sums([(total, count), (part_total, part_count)])
+    return total, count, files
+
+
+def create_average_with_numpy(files, scale=1):
+    # Create in-process, without ImageMagick or temp files
+    total, count, done = None, 0, set()
+    if args.state:
+        state_file = state_filename(args.outfile)
+        states = list(args.merge or [])
+        if args.append and os.path.exists(state_file):
+            states.insert(0, state_file)
+        if states:
+            total, count, done = merge_states(states)
+            print("Images already averaged:", count)
+        files = [f for f in files if os.path.abspath(f) not in done]
+        print("New images:", len(files))
+        # Save every so often so a crashed run can carry on with --append
+        chunk_size = args.checkpoint
+    else:
+        chunk_size = len(files)
+
+    for chunk in split_into_batches(files, max(chunk_size, 1)):
+        if args.jobs > 1:
+            if args.batch_size == "auto":
+                batch_size = None
+            else:
+                batch_size = int(args.batch_size or 0)
+            chunk_sum = sum_frames_in_parallel(chunk, args.jobs, batch_size, scale)
+        else:
+            chunk_sum = sum_frames(chunk, scale=scale)
+        total, count = merge_sums([(total, count), chunk_sum])
+        if args.state:
+            done.update(os.path.abspath(f) for f in chunk)
+            print("Save state to", state_file)
+            save_state(state_file, total, count, done)
+    if args.state and not files and total is not None:
+        # Only merged
+        print("Save state to", state_file)
+        save_state(state_file, total, count, done)
+
+    if total is None:
+        sys.exit("Nothing to average")
+    save_im(Image.fromarray(average_from_sum(total, count)))
+
+
+def sequence_filename(outfile, number):
+    """
+    >>> sequence_filename("out-average.jpg", 12)
+    'out-average-000012.jpg'
+    """
+    root, ext = os.path.splitext(outfile)
+    return root + "-" + str(number).zfill(6) + ext
+
+
+def moving_averages(frames, window):
+    """Yield the average of each run of `window` consecutive frames.
+
+    Keeps a running sum and a ring buffer of the last `window` frames. Each
+    step adds the newest frame and subtracts the oldest, so every frame is
+    decoded once and each average costs the same whatever the window size.
+    """
+    total = ring = None
+    for i, frame in enumerate(frames):
+        if total is None:
+            total = numpy.zeros(frame.shape, ACCUMULATOR_DTYPE)
+            ring = numpy.empty((window,) + frame.shape, numpy.uint8)
+        elif frame.shape != total.shape:
+            sys.exit("\nImages are different sizes. Tip: use --normalise.")
+        slot = i % window
+        if i >= window:
+            total -= ring[slot]
+        ring[slot] = frame
+        total += frame
+        if i >= window - 1:
+            yield average_from_sum(total, window)
+
+
+def create_moving_averages(frames, window):
+    # Output frame k is the average of input frames k to k + window - 1
+    number = 0
+    for number, average in enumerate(moving_averages(frames, window), 1):
+        Image.fromarray(average).save(
+            sequence_filename(args.outfile, number - 1), quality=95
+        )
+    if number == 0:
+        sys.exit("Window is bigger than the number of frames")
+    print("Number of output images:", number)
+
+
+def running_extremes(frames, lighten=True):
+    """Yield the per-pixel maximum (lighten) or minimum (darken) so far,
+    after each frame.
+
+    The same array is updated in place and yielded each time, so memory is
+    one frame plus the composite.
+    """
+    composite = None
+    for frame in frames:
+        if composite is None:
+            composite = frame.copy()
+        elif frame.shape != composite.shape:
+            sys.exit("\nImages are different sizes. Tip: use --normalise.")
+        elif lighten:
+            numpy.maximum(composite, frame, out=composite)
+        else:
+            numpy.minimum(composite, frame, out=composite)
+        yield composite
+
+
+def create_extreme_image(frames, lighten=True, trail_every=None):
+    # Star trails and light painting
+    composite = None
+    for i, composite in enumerate(running_extremes(frames, lighten), 1):
+        if trail_every and i % trail_every == 0:
+            filename = sequence_filename(args.outfile, i // trail_every - 1)
+            Image.fromarray(composite).save(filename, quality=95)
+    if composite is None:
+        sys.exit("No frames")
+    save_im(Image.fromarray(composite))
+
+
+def pick_random_pixels(files, rng=None, scale=1):
+    """For each pixel, take the pixel from a randomly chosen image.
+
+    One index map says which image feeds each pixel. Each image is then
+    decoded once and its chosen pixels copied in one vectorised operation.
+    """
     # All files should be the same dimension, so let's check the first one
-    first_image = Image.open(files[0])
-    width, height = first_image.size
-    print("Format:", first_image.format)
-    print("Mode:", first_image.mode)
+    with Image.open(files[0]) as first_image:
+        width, height = first_image.size
+        print("Format:", first_image.format)
+        print("Mode:", first_image.mode)
+    width, height = width // scale, height // scale
     print(width, "x", height)
-    # Create new blank image
-    new_image = Image.new("RGB", (width, height))
-    new_pix = new_image.load()
 
     # For each pixel, pick a random image and store its index
     print("Pick random images")
-    random_indices = []
-    num_files = len(files)
-    for y in range(0, height):
-        # print(y, height)
-        for x in range(0, width):
-            # Pick the x,y pixel from a random file
-            rand_no = random.randrange(0, num_files)
-            # print(rand_no)
-            random_indices.append((rand_no, (x, y)))
-
-    # Now sort by image index
-    print("Sort images")
-    random_indices.sort(key=itemgetter(0))
-
-    # Now open each image in turn and get the pixel
-    open_index = -1
-    open_pix = ""
-    for index, coord in random_indices:
-        # print(open_index, index)
-        if open_index != index:
-            open_index = index
-            # print("Get pixels from file", index)
-            open_pix = Image.open(files[index]).load()
-        new_pix[coord] = open_pix[coord]
+    if rng is None:
+        rng = numpy.random.default_rng()
+    index_map = rng.integers(
+        0, len(files), size=(height, width), dtype=numpy.min_scalar_type(len(files))
+    )
+
+    # Now open each image in turn and get its pixels
+    new_pixels = numpy.zeros((height, width, 3), numpy.uint8)
+    for index, filename in enumerate(files):
+        sys.stdout.write("\rProcessing file " + str(index + 1) + "/" + str(len(files)))
+        mask = index_map == index
+        if not mask.any():
+            continue
+        frame = load_frame(filename, scale)
+        if frame.shape != new_pixels.shape:
+            sys.exit(
+                "\nImage is a different size: " + filename + ". Tip: use --normalise."
+            )
+        new_pixels[mask] = frame[mask]
+    sys.stdout.write("\r\n")
+    return new_pixels
+
 
+def pick_random_pixels_from_frames(frames, rng=None):
+    """For each pixel, take the pixel from a randomly chosen frame, when the
+    number of frames isn't known in advance (such as from a video).
+
+    The kth frame replaces each pixel with probability 1/k, which leaves
+    every frame equally likely to be picked.
+    """
+    if rng is None:
+        rng = numpy.random.default_rng()
+    new_pixels = None
+    for k, frame in enumerate(frames, 1):
+        if new_pixels is None:
+            new_pixels = frame.copy()
+            continue
+        if frame.shape != new_pixels.shape:
+            sys.exit("\nImages are different sizes. Tip: use --normalise.")
+        mask = rng.integers(0, k, size=frame.shape[:2], dtype=numpy.uint32) == 0
+        new_pixels[mask] = frame[mask]
+    return new_pixels
+
+
+def create_randomised_image(files, scale=1):
     # We have all the random pixels, save them
-    save_im(new_image)
+    save_im(Image.fromarray(pick_random_pixels(files, scale=scale)))
+
+
+def iter_tiles(width, height, tile_size):
+    """Boxes covering the image, in rows of tiles.
+
+    >>> list(iter_tiles(5, 3, 2))
+    [(0, 0, 2, 2), (2, 0, 4, 2), (4, 0, 5, 2), (0, 2, 2, 3), (2, 2, 4, 3), (4, 2, 5, 3)]
+    """
+    for upper in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            yield (
+                left,
+                upper,
+                min(left + tile_size, width),
+                min(upper + tile_size, height),
+            )
+
+
+def composite_tiles(files, boxes, effect, rng):
+    """Make some tiles of the composite.
+
+    Each image is opened once for all the tiles, and only the regions still
+    needed are read from it.
+    """
+    shapes = [(lower - upper, right - left, 3) for left, upper, right, lower in boxes]
+    if effect == "average":
+        totals = [numpy.zeros(shape, ACCUMULATOR_DTYPE) for shape in shapes]
+    else:
+        dtype = numpy.min_scalar_type(len(files))
+        index_maps = [
+            rng.integers(0, len(files), size=shape[:2], dtype=dtype) for shape in shapes
+        ]
+        tiles = [numpy.zeros(shape, numpy.uint8) for shape in shapes]
+
+    for index, filename in enumerate(files):
+        if effect == "random":
+            masks = [index_map == index for index_map in index_maps]
+            wanted = [i for i, mask in enumerate(masks) if mask.any()]
+            if not wanted:
+                continue
+        else:
+            wanted = range(len(boxes))
+        regions = region_reader.read_regions(filename, [boxes[i] for i in wanted])
+        for i, region in zip(wanted, regions):
+            if region.shape != shapes[i]:
+                sys.exit(
+                    "\nImage is too small: " + filename + ". Tip: use --normalise."
+                )
+            if effect == "average":
+                totals[i] += region
+            else:
+                tiles[i][masks[i]] = region[masks[i]]
+
+    if effect == "average":
+        return [average_from_sum(total, len(files)) for total in totals]
+    return tiles
+
+
+def create_tiled_image(files, effect, tile_size):
+    """Average or random composite, made a few tiles at a time.
+
+    Each tile is written straight into a memory-mapped uncompressed TIFF, so
+    memory depends on the tile size, not the image size. Uncompressed TIFF
+    input is read a region at a time too; other input has to be decoded
+    from the top down to the tiles, once for each TILES_PER_READ tiles.
+    """
+    with Image.open(files[0]) as first_image:
+        width, height = first_image.size
+    print(width, "x", height)
+    out = bigimage.create_tiff_memmap(args.outfile, width, height)
+
+    rng = numpy.random.default_rng()
+    chunks = [
+        chunk
+        for upper, row in groupby(
+            iter_tiles(width, height, tile_size), key=lambda box: box[1]
+        )
+        for chunk in split_into_batches(list(row), TILES_PER_READ)
+    ]
+    for i, boxes in enumerate(chunks):
+        sys.stdout.write("\rProcessing tiles " + str(i + 1) + "/" + str(len(chunks)))
+        for box, tile in zip(boxes, composite_tiles(files, boxes, effect, rng)):
+            left, upper, right, lower = box
+            out[upper:lower, left:right] = tile
+    sys.stdout.write("\r\n")
+    out.flush()
+    del out
+    print("Saved to", args.outfile)
+
+
+def check_disk_space(directory, needed):
+    free = shutil.disk_usage(directory).free
+    if needed > free:
+        sys.exit(
+            "\nNot enough disk space in %s: %.1f MB needed, %.1f MB free"
+            % (directory, needed / 1024 / 1024, free / 1024 / 1024)
+        )
+
+
+def spill_frames(frames, temp_dir, expected=None):
+    """Write each decoded frame once into a raw (frames, height, width, 3) file.
+
+    Returns it memory-mapped, so any row band can be read back from every
+    frame without decoding them again or holding them all in memory.
+
+    If the number of frames is expected, there must be disk space for them
+    all before any is written. Otherwise it's checked for each frame.
+    """
+    path = os.path.join(temp_dir, "frames.raw")
+    shape, count = None, 0
+    with open(path, "wb") as f:
+        for frame in frames:
+            if shape is None:
+                shape = frame.shape
+                if expected:
+                    check_disk_space(temp_dir, frame.nbytes * expected)
+            elif frame.shape != shape:
+                sys.exit("\nImages are different sizes. Tip: use --normalise.")
+            if not expected:
+                check_disk_space(temp_dir, frame.nbytes)
+            frame.tofile(f)
+            count += 1
+    if shape is None:
+        sys.exit("No frames")
+    return numpy.memmap(path, numpy.uint8, "r", shape=(count,) + shape)
+
+
+def percentile_composite(stack, percentile, max_memory):
+    """Per-pixel percentile over a stack of images, one row band at a time.
+
+    stack       (images, height, width, 3) array, usually memory-mapped
+    percentile  0 to 100, 50 being the median
+    max_memory  Bytes to use for each band
+    """
+    count, height, width, channels = stack.shape
+    # numpy.percentile partitions a copy of the band, so allow for two
+    band_height = max(1, max_memory // (2 * count * width * channels))
+    if band_height < height:
+        print("Band height:", band_height)
+
+    out = numpy.empty((height, width, channels), numpy.uint8)
+    for top in range(0, height, band_height):
+        sys.stdout.write("\rProcessing row " + str(top + 1) + "/" + str(height))
+        band = numpy.asarray(stack[:, top : top + band_height])
+        out[top : top + band_height] = numpy.rint(
+            numpy.percentile(band, percentile, axis=0)
+        )
+    sys.stdout.write("\r\n")
+    return out
+
+
+def create_percentile_image(frames, percentile, expected=None):
+    # Median and other percentiles need every image's value at each pixel
+    stack = spill_frames(frames, create_temp_dir(), expected)
+    max_memory = args.max_memory * 1024 * 1024
+    save_im(Image.fromarray(percentile_composite(stack, percentile, max_memory)))
+    del stack  # close the memory map before the temp dir is removed
+
+
+def align_files(inspec):
+    # Line every image up with the middle one, before any effect sees it
+    files = sorted(get_file_list(inspec))
+    reference = files[len(files) // 2]
+    print("Align to:", reference)
+    start = time.perf_counter()
+    offsets = align.estimate_offsets(
+        files,
+        reference,
+        rotation=args.align == "rotation",
+        jobs=args.jobs,
+        cache_file=os.path.splitext(args.outfile)[0] + ".align.json",
+    )
+    print("Alignment took: %.1f seconds" % (time.perf_counter() - start))
+    set_frame_offsets(offsets)
+
+
+def decode_time(inspec, scale=1):
+    # Seconds to decode the first frame
+    start = time.perf_counter()
+    if videoutils.is_video(inspec):
+        frames = get_frames(inspec, scale)
+        next(frames, None)
+        frames.close()
+    else:
+        load_frame(get_file_list(inspec)[0], scale)
+    return time.perf_counter() - start
+
+
+def report_preview(inspec, elapsed, scale):
+    print("Preview took: %.1f seconds" % elapsed)
+    # Estimate the full run from how much slower a full-size decode is
+    reduced = decode_time(inspec, scale)
+    full = decode_time(inspec)
+    print("Full run estimate: %.1f seconds" % (elapsed * full / reduced))
 
 
 def save_im(im):
@@ -226,7 +771,9 @@ if __name__ == "__main__":
         "Requires PIL and ImageMagick's magick.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    parser.add_argument("-i", "--inspec", default="*.jpg", help="Input file spec")
+    parser.add_argument(
+        "-i", "--inspec", default="*.jpg", help="Input file spec, or a video file"
+    )
     parser.add_argument(
         "-o", "--outfile", help="Output file name"  # default='out.jpg',
     )
@@ -240,9 +787,24 @@ if __name__ == "__main__":
         "-e",
         "--effect",
         default="average",
-        choices=("average", "random", "nowt"),
+        choices=(
+            "average",
+            "random",
+            "median",
+            "percentile",
+            "lighten",
+            "darken",
+            "nowt",
+        ),
         help="Effect to apply",
     )
+    parser.add_argument(
+        "--engine",
+        default="magick",
+        choices=("magick", "numpy"),
+        help="For average: Use ImageMagick, or NumPy to add each image into a "
+        "single accumulator without temp files",
+    )
     parser.add_argument(
         "-n",
         "--normalise",
@@ -253,6 +815,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "-k", "--keep_normals", action="store_true", help="Keep normalised images"
     )
+    parser.add_argument(
+        "--align",
+        nargs="?",
+        const="translation",
+        choices=("translation", "rotation"),
+        help="Line the images up with the middle one before combining them, "
+        "for handheld or shaky shots. 'rotation' also corrects rotation. "
+        "Offsets are cached in OUTFILE.align.json. Average uses --engine numpy.",
+    )
 
     import doctest
 
@@ -263,7 +834,108 @@ if __name__ == "__main__":
         "-b",
         "--batch-size",  # type=int,
         help="For average: Batch size. For best results, should be a "
-        "factor of the total number. Use 'auto' to calculate size.",
+        "factor of the total number. Use 'auto' to calculate size. "
+        "With --engine numpy and --jobs, the number of images per worker task.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="For average with --engine numpy: Number of worker processes "
+        "summing batches in parallel. Use 0 for all CPUs.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        help="For average: Make a numbered sequence where output k is the "
+        "average of input images k to k+WINDOW-1, in filename order",
+    )
+    parser.add_argument(
+        "--state",
+        action="store_true",
+        help="For average: Save the per-pixel sums and image count next to "
+        "the output, as OUTFILE.npz. Uses --engine numpy.",
+    )
+    parser.add_argument(
+        "-a",
+        "--append",
+        action="store_true",
+        help="For average: Carry on from a saved state, only reading images "
+        "not already in it. Also resumes a crashed run. Implies --state.",
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="STATE",
+        help="For average: Combine these saved states without reading any "
+        "images. Implies --state.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=int,
+        default=100,
+        help="For average with --state: Save the state after this many images",
+    )
+
+    parser.add_argument(
+        "-t",
+        "--tile-size",
+        type=int,
+        metavar="pixels",
+        help="For average and random: Make the output in tiles of this size, "
+        "reading only the matching region of each image, for images too big "
+        "for memory. The output must be TIFF. Best with uncompressed TIFF input.",
+    )
+
+    parser.add_argument(
+        "--preview",
+        type=int,
+        choices=(2, 4, 8),
+        help="Quickly make a preview from images decoded at 1/2, 1/4 or 1/8 "
+        "size, and estimate how long the full run will take",
+    )
+
+    # For video input:
+    parser.add_argument(
+        "--nth",
+        type=int,
+        metavar="N",
+        help="For video input: Only use every Nth frame",
+    )
+    parser.add_argument(
+        "--start", type=float, help="For video input: Seconds to start from"
+    )
+    parser.add_argument(
+        "--duration", type=float, help="For video input: Seconds of video to use"
+    )
+
+    # For median and percentile composites:
+    parser.add_argument(
+        "-p",
+        "--percentile",
+        type=float,
+        default=50,
+        help="For percentile: Which percentile of each pixel to take (0-100)",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=1024,
+        help="For median and percentile: MB to use for each row band. "
+        "Images are first spilled to a temp file, which needs free disk space "
+        "for every image uncompressed (width x height x 3 bytes each).",
+    )
+
+    # For lighten and darken composites:
+    parser.add_argument(
+        "--trail-every",
+        type=int,
+        metavar="N",
+        help="For lighten and darken: Also save the composite so far after "
+        "every N images, as a numbered sequence",
     )
 
     # For random-pixel composites:
@@ -276,18 +948,62 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
     print(args)
+    if args.jobs == 0:
+        args.jobs = os.cpu_count()
+    if args.append or args.merge:
+        args.state = True
 
     # If inspec is dir, append *.jpg
     inspec = args.inspec
     if os.path.isdir(inspec):
         inspec = os.path.join(inspec, "*.jpg")
 
+    if args.preview and (args.state or args.tile_size):
+        sys.exit(
+            "--preview can't be used with --state, --append, --merge or --tile-size"
+        )
+    scale = args.preview or 1
+
     if not args.outfile:
-        args.outfile = "out-" + args.effect + ".jpg"
+        args.outfile = "out-" + args.effect
+        if args.preview:
+            args.outfile += "-preview"
+        args.outfile += ".tif" if args.tile_size else ".jpg"
 
     if args.noclobber and os.path.exists(args.outfile):
         sys.exit("Output file (" + args.outfile + ") already exists, exiting")
 
+    video = videoutils.is_video(inspec)
+    if video and (
+        args.normalise or args.state or args.tile_size or args.jobs > 1 or args.align
+    ):
+        sys.exit(
+            "Video input can't be used with --normalise, --state, --append, "
+            "--merge, --tile-size, --jobs or --align"
+        )
+    if args.window is not None and args.window < 1:
+        sys.exit("--window must be at least 1")
+    if not 0 <= args.percentile <= 100:
+        sys.exit("--percentile must be from 0 to 100")
+    if args.tile_size and (
+        args.effect not in ("average", "random")
+        or args.window
+        or args.jobs > 1
+        or args.batch_size
+        or args.normalise
+        or args.align
+        or args.state
+    ):
+        sys.exit(
+            "--tile-size can only be used with --effect average or random, and "
+            "not with --window, --jobs, --batch-size, --normalise, --align, "
+            "--state, --append or --merge"
+        )
+    if args.tile_size and not bigimage.is_tiff(args.outfile):
+        sys.exit("--tile-size can only save to TIFF")
+    if args.align:
+        args.engine = "numpy"
+
     if args.normalise:
         print("Normalise input images")
 
@@ -302,15 +1018,62 @@ if __name__ == "__main__":
         inspec = normalise.normalise_files(inspec, files, args.normalise, temp_dir)
         print(inspec)
 
+    if args.align and args.effect != "nowt":
+        align_files(inspec)
+
     print("Effect:", args.effect)
-    if args.effect == "average":
-        if args.batch_size:
+    start = time.perf_counter()
+    if args.tile_size:
+        create_tiled_image(get_file_list(inspec), args.effect, args.tile_size)
+
+    elif args.effect == "average" and args.window:
+        if video:
+            create_moving_averages(get_frames(inspec, scale), args.window)
+        else:
+            files = sorted(get_file_list(inspec))
+            if args.window > len(files):
+                sys.exit("Window is bigger than the number of images")
+            create_moving_averages(iter_frames(files, scale), args.window)
+
+    elif args.effect == "average":
+        if args.merge:
+            create_average_with_numpy([])
+        elif video:
+            total, count = add_frames(get_frames(inspec, scale))
+            if count == 0:
+                sys.exit("No frames")
+            save_im(Image.fromarray(average_from_sum(total, count)))
+        elif args.engine == "numpy" or args.state or args.preview:
+            create_average_with_numpy(get_file_list(inspec), scale)
+        elif args.batch_size:
             create_average_in_batches(inspec)
         else:
             create_average_in_one_go(inspec)
 
+    elif args.effect == "random" and video:
+        pixels = pick_random_pixels_from_frames(get_frames(inspec, scale))
+        if pixels is None:
+            sys.exit("No frames")
+        save_im(Image.fromarray(pixels))
+
     elif args.effect == "random":
-        create_randomised_image(get_file_list(inspec))
+        create_randomised_image(get_file_list(inspec), scale)
+
+    elif args.effect in ("median", "percentile"):
+        percentile = 50 if args.effect == "median" else args.percentile
+        if video:
+            create_percentile_image(get_frames(inspec, scale), percentile)
+        else:
+            files = sorted(get_file_list(inspec))
+            create_percentile_image(iter_frames(files, scale), percentile, len(files))
+
+    elif args.effect in ("lighten", "darken"):
+        create_extreme_image(
+            get_frames(inspec, scale), args.effect == "lighten", args.trail_every
+        )
+
+    if args.preview and args.effect != "nowt":
+        report_preview(inspec, time.perf_counter() - start, args.preview)
 
     remove_temp_dirs()
 
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Read rectangular regions of an image file, decoding as little of it as the
+format allows:
+
+* Uncompressed RGB TIFFs (such as those from bigimage.py) are memory-mapped,
+  so only the region is read from disk.
+* Baseline JPEGs and non-interlaced PNGs are decoded from the top and stop
+  after the lowest row needed.
+* Other images made of several tiles or strips only decode the tiles that
+  overlap the regions.
+* Anything else is decoded in full and cropped.
+
+JPEG can't be decoded from partway across or down with Pillow, so regions
+near the top of an image are cheapest.
+"""
+from __future__ import annotations
+
+import numpy
+from PIL import Image
+
+# Bytes of pixels decoded, and bytes of them kept in regions
+stats = {"decoded": 0, "kept": 0}
+
+
+def is_raw_rgb(im):
+    # Uncompressed, top-down, tightly packed RGB strips or tiles?
+    for decoder_name, extents, offset, args in im.tile:
+        if decoder_name != "raw":
+            return False
+        if isinstance(args, str):
+            args = (args, 0, 1)
+        rawmode, stride, orientation = args[:3]
+        tile_width = extents[2] - extents[0]
+        if rawmode != "RGB" or stride not in (0, tile_width * 3) or orientation != 1:
+            return False
+    return im.mode == "RGB" and len(im.tile) > 0
+
+
+def read_raw_region(filename, tiles, box):
+    # Copy the region straight out of the memory-mapped strips or tiles
+    left, upper, right, lower = box
+    region = numpy.zeros((lower - upper, right - left, 3), numpy.uint8)
+    data = numpy.memmap(filename, numpy.uint8, "r")
+    for decoder_name, extents, offset, args in tiles:
+        tile_left, tile_upper, tile_right, tile_lower = extents
+        x0, y0 = max(left, tile_left), max(upper, tile_upper)
+        x1, y1 = min(right, tile_right), min(lower, tile_lower)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        size = (tile_lower - tile_upper) * (tile_right - tile_left) * 3
+        tile = data[offset : offset + size].reshape(
+            tile_lower - tile_upper, tile_right - tile_left, 3
+        )
+        region[y0 - upper : y1 - upper, x0 - left : x1 - left] = tile[
+            y0 - tile_upper : y1 - tile_upper, x0 - tile_left : x1 - tile_left
+        ]
+    return region
+
+
+def stops_early(im):
+    # Decoded top to bottom in one go, so decoding can stop partway down?
+    if len(im.tile) != 1:
+        return False
+    decoder_name, extents = im.tile[0][:2]
+    if tuple(extents) != (0, 0) + im.size:
+        return False
+    if decoder_name == "jpeg":
+        return not im.info.get("progressive")
+    return decoder_name == "zip" and not im.info.get("interlace")
+
+
+def decode_top(im, lower):
+    # Decode only the rows above lower
+    decoder_name, extents, offset, args = im.tile[0]
+    im.tile = [(decoder_name, (0, 0, im.width, lower), offset, args)]
+    im._size = (im.width, lower)
+    try:
+        im.load()
+    except OSError:
+        # Stopping before the end of the data can be reported as an error,
+        # but only after all the rows are decoded and im.tile is emptied.
+        # Running out of data before then means the file really is truncated.
+        if im.tile:
+            raise
+
+
+def overlaps(extents, boxes):
+    left, upper, right, lower = extents
+    return any(
+        box[0] < right and left < box[2] and box[1] < lower and upper < box[3]
+        for box in boxes
+    )
+
+
+def read_regions(filename, boxes):
+    """Return each box (left, upper, right, lower) of an image as an RGB array.
+
+    The image is opened once, and only as much of it is decoded as the
+    format allows. The bytes decoded and kept are added to stats.
+    """
+    with Image.open(filename) as im:
+        if is_raw_rgb(im):
+            regions = [read_raw_region(filename, im.tile, box) for box in boxes]
+            stats["decoded"] += sum(region.nbytes for region in regions)
+            stats["kept"] += sum(region.nbytes for region in regions)
+            return regions
+
+        bands = len(im.getbands())
+        lower = max(1, min(im.height, max(box[3] for box in boxes)))
+        if stops_early(im):
+            decode_top(im, lower)
+            stats["decoded"] += im.width * lower * bands
+        elif len(im.tile) > 1:
+            im.tile = [tile for tile in im.tile if overlaps(tile[1], boxes)]
+            stats["decoded"] += sum(
+                (right - left) * (bottom - top) * bands
+                for _, (left, top, right, bottom), _, _ in im.tile
+            )
+        else:
+            stats["decoded"] += im.width * im.height * bands
+        regions = [numpy.asarray(im.crop(box).convert("RGB")) for box in boxes]
+        stats["kept"] += sum(region[..., 0].size * bands for region in regions)
+        return regions
+
+
+def read_region(filename, box):
+    """Return the box (left, upper, right, lower) of an image as an RGB array"""
+    return read_regions(filename, [box])[0]
+
+
+def report():
+    if stats["decoded"]:
+        print(
+            "Decoded: %.1f MB, kept: %.1f MB (%.1f%%)"
+            % (
+                stats["decoded"] / 1024 / 1024,
+                stats["kept"] / 1024 / 1024,
+                100 * stats["kept"] / stats["decoded"],
+            )
+        )
+
+
+# End of file
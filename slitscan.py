@@ -8,13 +8,95 @@ import argparse
 import glob
 import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy
 from PIL import Image
 
+import bigimage
+import region_reader
+import videoutils
+
 # PIL jpeg saving: Maximum supported image dimension is 65500 pixels
 MAX_DIMENSION = 65500
 
 
+class SliceCache:
+    """Keep the decoded images between passes of --engine reread, within a
+    byte budget.
+
+    Each pass takes its slice further along than the last, so only the rest
+    of each image from the current slice onwards is kept, as an array.
+    Entries shrink as their slices are used, making room for more images.
+
+    An image is added when its remainder fits in what's left of the budget.
+    Nothing is evicted to make room: every pass reads the images in the same
+    order, so evicting the least recently used would throw each image away
+    just before it's needed again.
+    """
+
+    def __init__(self, max_bytes, vertical):
+        self.max_bytes = max_bytes
+        self.axis = 1 if vertical else 0
+        self.entries = {}  # index: (offset, remainder)
+        self.bytes = self.peak_bytes = 0
+        self.hits = self.misses = 0
+
+    def cut(self, array, offset, start, end=None):
+        # Columns (or rows) start to end of an image, from its remainder
+        index = [slice(None)] * 3
+        index[self.axis] = slice(
+            max(start, 0) - offset, None if end is None else end - offset
+        )
+        piece = array[tuple(index)]
+        if start < 0:
+            # Before the edge is black, like Image.crop
+            padding = [(0, 0)] * 3
+            padding[self.axis] = (-start, 0)
+            piece = numpy.pad(piece, padding)
+        return piece
+
+    def crop(self, index, filename, box):
+        """Image.open(filename).crop(box), for the image at this index"""
+        start, end = (box[0], box[2]) if self.axis == 1 else (box[1], box[3])
+        if index in self.entries:
+            self.hits += 1
+            offset, remainder = self.entries[index]
+            used = max(start, 0) - offset
+            if used * 2 >= remainder.shape[self.axis]:
+                # Copying frees the used part, so only do it when it's big
+                self.bytes -= remainder.nbytes
+                remainder = self.cut(remainder, offset, offset + used).copy()
+                offset += used
+                self.bytes += remainder.nbytes
+                self.entries[index] = offset, remainder
+            return Image.fromarray(self.cut(remainder, offset, start, end))
+
+        self.misses += 1
+        with Image.open(filename) as im:
+            array = numpy.asarray(im.convert("RGB"))
+        offset = max(start, 0)
+        remainder = self.cut(array, 0, offset)
+        if self.bytes + remainder.nbytes <= self.max_bytes:
+            self.entries[index] = offset, remainder.copy()
+            self.bytes += remainder.nbytes
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+        return Image.fromarray(self.cut(array, 0, start, end))
+
+    def report(self):
+        lookups = self.hits + self.misses
+        print("Cache hits:\t", self.hits, "/", lookups)
+        print("Cache misses:\t", self.misses, "/", lookups)
+        print("Cache images:\t", len(self.entries))
+        print("Cache peak:\t %.1f MB" % (self.peak_bytes / (1024 * 1024)))
+
+
+def crop_file(filename, box):
+    # Only the small slice is sent back from a worker process
+    return Image.fromarray(region_reader.read_region(filename, box))
+
+
 def sanity_check(files):
     num_files = len(files)
     print("Input images:\t", num_files)
@@ -22,7 +104,324 @@ def sanity_check(files):
         sys.exit("Not enough input images")
 
 
-def make_image(files):
+def slice_starts(in_size, number_of_outputs, slice_thickness):
+    """For --mode all, where each output takes its slice from every image.
+
+    >>> slice_starts(10, 5, 2)
+    [-1, 1, 3, 5, 7]
+    """
+    return [
+        int(in_size * j / number_of_outputs - slice_thickness / 2)
+        for j in range(number_of_outputs)
+    ]
+
+
+def cut_slices(frame, starts, slice_thickness, vertical):
+    """Cut a slice for each start from an image array, all at once.
+
+    Parts of a slice before the edge are black, like Image.crop.
+    Returns an array of (len(starts), height, thickness, 3) for vertical
+    slices, or (len(starts), thickness, width, 3) for horizontal ones.
+    """
+    axis = 1 if vertical else 0
+    # Pad so slices starting before the edge can be indexed
+    pad = max(0, -min(starts))
+    if pad:
+        padding = [(0, 0)] * frame.ndim
+        padding[axis] = (pad, 0)
+        frame = numpy.pad(frame, padding)
+    indices = numpy.add.outer(numpy.asarray(starts) + pad, range(slice_thickness))
+    indices = numpy.clip(indices, 0, frame.shape[axis] - 1)
+    if vertical:
+        return frame[:, indices].transpose(1, 0, 2, 3)
+    return frame[indices]
+
+
+def make_all_images_in_one_pass(files, vertical, slice_thickness, number_of_slices):
+    """--mode all: decode each image once and cut its slices for every output.
+
+    The slices are held in a memory-mapped stack in a temp file, one image
+    after another, then each output is gathered from it and saved.
+    """
+    in_width, in_height = Image.open(files[0]).size
+    in_size = in_width if vertical else in_height
+    starts = slice_starts(in_size, number_of_slices, slice_thickness)
+
+    todo = []
+    for j in range(number_of_slices):
+        outfile = args.outfile + "-" + str(j).zfill(6) + ".jpg"
+        if os.path.exists(outfile) and not args.video:
+            print("File exists, skipping:", outfile)
+        else:
+            todo.append(j)
+    if not todo:
+        return
+    todo_starts = [starts[j] for j in todo]
+
+    if vertical:
+        slice_shape = (in_height, slice_thickness, 3)
+    else:
+        slice_shape = (slice_thickness, in_width, 3)
+    stack_shape = (len(files), len(todo)) + slice_shape
+    print("Slice stack:\t", numpy.prod(stack_shape) // (1024 * 1024), "MB")
+
+    temp_parent = os.path.dirname(os.path.abspath(args.outfile))
+    with tempfile.TemporaryDirectory(dir=temp_parent) as temp_dir:
+        stack = numpy.memmap(
+            os.path.join(temp_dir, "slices.raw"), numpy.uint8, "w+", shape=stack_shape
+        )
+        for i, filename in enumerate(files):
+            sys.stdout.write("\rProcessing file " + str(i + 1) + "/" + str(len(files)))
+            with Image.open(filename) as im:
+                frame = numpy.asarray(im.convert("RGB"))
+            if frame.shape != (in_height, in_width, 3):
+                sys.exit("\nImage is a different size: " + filename)
+            stack[i] = cut_slices(frame, todo_starts, slice_thickness, vertical)
+        sys.stdout.write("\r\n")
+
+        if vertical:
+            out_shape = (in_height, slice_thickness * len(files), 3)
+        else:
+            out_shape = (slice_thickness * len(files), in_width, 3)
+        writer = (
+            videoutils.FrameWriter(args.video, args.framerate) if args.video else None
+        )
+        for k, j in enumerate(todo):
+            outfile = args.outfile + "-" + str(j).zfill(6) + ".jpg"
+            sys.stdout.write("\rSaving " + str(k + 1) + "/" + str(len(todo)))
+            if starts[j] + slice_thickness > in_size:
+                # Slice goes off the edge, so nothing is pasted
+                out = numpy.full(out_shape, 255, numpy.uint8)
+            elif vertical:
+                out = stack[:, k].transpose(1, 0, 2, 3).reshape(out_shape)
+            else:
+                out = stack[:, k].reshape(out_shape)
+            if writer:
+                # Copied out of the stack, so it's still there while encoding
+                writer.put(numpy.array(out))
+            else:
+                Image.fromarray(out).save(outfile, quality=95)
+        sys.stdout.write("\r\n")
+        if writer:
+            print("Video frames:\t", writer.close())
+        del stack
+
+
+def slit_box(width, height, vertical, thickness, position):
+    """The slit `position` percent across the image, as for --mode fixed.
+
+    >>> slit_box(100, 50, True, 2, 50)
+    (49, 0, 51, 50)
+    """
+    if vertical:
+        left = int(width * position / 100 - thickness * position / 100)
+        return (left, 0, left + thickness, height)
+    upper = int(height * position / 100 - thickness * position / 100)
+    return (0, upper, width, upper + thickness)
+
+
+def rolling_slitscans(slices, window, vertical):
+    """After each slice, yield the slit-scan of the last `window` slices.
+
+    Each slice is written twice into a buffer two windows long, so the last
+    `window` slices are always one contiguous view, oldest first. A new
+    slice only writes itself: nothing else is moved or re-read, so the cost
+    of each output doesn't grow with the window.
+
+    The same buffer is reused, so use each output before the next.
+    """
+    axis = 1 if vertical else 0
+    buffer = None
+    for i, piece in enumerate(slices):
+        thickness = piece.shape[axis]
+        if buffer is None:
+            shape = list(piece.shape)
+            shape[axis] = 2 * window * thickness
+            buffer = numpy.zeros(shape, numpy.uint8)
+        slot = i % window
+        for position in (slot, slot + window):
+            if vertical:
+                buffer[:, position * thickness : (position + 1) * thickness] = piece
+            else:
+                buffer[position * thickness : (position + 1) * thickness] = piece
+        if i >= window - 1:
+            start = (slot + 1) * thickness
+            end = start + window * thickness
+            yield buffer[:, start:end] if vertical else buffer[start:end]
+
+
+def slit_map(geometry, width, height, number_of_frames):
+    """Which frame each output pixel comes from, for a curved or angled slit.
+
+    Each geometry gives every pixel a position from 0 to 1 along the run of
+    frames; the slit is the line of pixels sharing a position.
+
+    >>> slit_map("diagonal", 4, 2, 3).tolist()
+    [[0, 0, 1, 1], [1, 2, 2, 2]]
+    """
+    y, x = numpy.mgrid[0:height, 0:width].astype(float)
+    x /= max(width - 1, 1)
+    y /= max(height - 1, 1)
+    if geometry == "diagonal":
+        position = (x + y) / 2
+    elif geometry == "radial":
+        # Out from the centre
+        radius = numpy.hypot(x - 0.5, y - 0.5)
+        position = radius / radius.max()
+    elif geometry == "angular":
+        # Clockwise round the centre, starting on the left
+        position = (numpy.arctan2(y - 0.5, x - 0.5) + numpy.pi) / (2 * numpy.pi)
+    elif geometry == "wave":
+        # A vertical slit with a sine wave in it
+        position = 0.1 + 0.8 * x + 0.1 * numpy.sin(2 * numpy.pi * y)
+    else:
+        raise ValueError("Unknown geometry: " + geometry)
+    frames = numpy.minimum(position * number_of_frames, number_of_frames - 1)
+    return frames.astype(numpy.min_scalar_type(number_of_frames))
+
+
+def fill_from_map(files, frame_map):
+    """Make an image where each pixel is that pixel of the frame in frame_map.
+
+    The pixels are grouped by frame once, so each frame is opened once, only
+    the box around its pixels is decoded, and its pixels are copied in one
+    vectorised operation.
+    """
+    height, width = frame_map.shape
+    out = numpy.zeros((height, width, 3), numpy.uint8)
+    flat = frame_map.ravel()
+    order = numpy.argsort(flat, kind="stable")
+    ends = numpy.cumsum(numpy.bincount(flat, minlength=len(files)))
+    start = 0
+    for i, filename in enumerate(files):
+        sys.stdout.write("\rProcessing file " + str(i + 1) + "/" + str(len(files)))
+        pixels = order[start : ends[i]]
+        start = ends[i]
+        if len(pixels) == 0:
+            continue
+        ys, xs = numpy.divmod(pixels, width)
+        left, upper = xs.min(), ys.min()
+        box = (int(left), int(upper), int(xs.max()) + 1, int(ys.max()) + 1)
+        region = region_reader.read_region(filename, box)
+        out[ys, xs] = region[ys - upper, xs - left]
+    sys.stdout.write("\r\n")
+    return out
+
+
+def make_mapped_image(files):
+    # One image, each pixel taken from a frame chosen by the slit geometry
+    if not args.outfile:
+        args.outfile = "out-" + args.geometry + ".jpg"
+    print("Outfile:", args.outfile)
+    width, height = Image.open(files[0]).size
+    frame_map = slit_map(args.geometry, width, height, len(files))
+    print("Frames used:\t", len(numpy.unique(frame_map)))
+    out = fill_from_map(files, frame_map)
+    region_reader.report()
+    print("Saving to", args.outfile)
+    Image.fromarray(out).save(args.outfile, quality=95)
+
+
+def make_rolling_slitscan(files):
+    # A slit-scan of the last few images for every input image, as a sequence
+    if not args.outfile:
+        args.outfile = "out-" + args.direction + "-rolling.jpg"
+    vertical = args.direction in ("vertical", "v")
+    thickness = args.thickness or 1
+
+    if files is None:
+        size = videoutils.frame_size(args.inspec)
+        if size is None:
+            sys.exit("No frames")
+        in_width, in_height = size
+    else:
+        in_width, in_height = Image.open(files[0]).size
+    left, upper, right, lower = slit_box(
+        in_width, in_height, vertical, thickness, args.fixedposition
+    )
+    window = args.window or (in_width if vertical else in_height) // thickness
+    print("Window:\t\t", window)
+
+    def iter_slices():
+        if files is None:
+            for frame in videoutils.read_frames(args.inspec):
+                yield frame[upper:lower, left:right]
+            return
+        for i, filename in enumerate(files):
+            sys.stdout.write("\rProcessing file " + str(i + 1) + "/" + str(len(files)))
+            yield numpy.asarray(crop_file(filename, (left, upper, right, lower)))
+        sys.stdout.write("\r\n")
+
+    outputs = rolling_slitscans(iter_slices(), window, vertical)
+    if args.video:
+        count = videoutils.write_frames(args.video, outputs, args.framerate)
+    else:
+        count = 0
+        for count, frame in enumerate(outputs, 1):
+            outfile = args.outfile + "-" + str(count - 1).zfill(6) + ".jpg"
+            Image.fromarray(frame).save(outfile, quality=95)
+    print("Output frames:\t", count)
+    region_reader.report()
+
+
+def crop_file_many(filename, boxes):
+    # Decode once, crop many
+    return [
+        Image.fromarray(region)
+        for region in region_reader.read_regions(filename, boxes)
+    ]
+
+
+def make_images_together(plans, files):
+    """Make several outputs while decoding each input image only once.
+
+    plans   (outfile, canvas, slices) for each output, from make_image
+    """
+    # For each file, which slices go where
+    pastes = {}
+    for outfile, canvas, slices in plans:
+        for i, filename, crop_bbox, paste_bbox in slices:
+            pastes.setdefault(filename, []).append((canvas, crop_bbox, paste_bbox))
+    todo = [filename for filename in files if filename in pastes]
+    print("Outputs:\t", len(plans))
+
+    def boxes(filename):
+        return [crop_bbox for canvas, crop_bbox, paste_bbox in pastes[filename]]
+
+    if args.jobs > 1:
+        print("Workers:\t", args.jobs)
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        crops = executor.map(
+            crop_file_many,
+            todo,
+            [boxes(filename) for filename in todo],
+            chunksize=max(1, len(todo) // (args.jobs * 4)),
+        )
+    else:
+        executor = None
+        crops = (crop_file_many(filename, boxes(filename)) for filename in todo)
+
+    for n, (filename, imgs) in enumerate(zip(todo, crops)):
+        sys.stdout.write("\rProcessing file " + str(n + 1) + "/" + str(len(todo)))
+        for img, (canvas, crop_bbox, paste_bbox) in zip(imgs, pastes[filename]):
+            canvas.paste(img, paste_bbox)
+    sys.stdout.write("\r\n")
+    if executor:
+        executor.shutdown()
+
+    region_reader.report()
+
+    for outfile, canvas, slices in plans:
+        print("Saving to", outfile)
+        canvas.save(outfile, quality=95)
+
+
+def make_image(files, plan_only=False):
+    """Make the output image(s).
+
+    With plan_only, don't read any images, but return (outfile, blank
+    canvas, slices) for make_images_together, or None if the output exists.
+    """
     if not args.outfile:
         args.outfile = "out-" + args.direction + "-" + args.mode
         if args.greedy:
@@ -89,22 +488,27 @@ def make_image(files):
         out_width = in_width
         out_height = in_height
 
+    # A TIFF output is written straight to disk, so has no size limit
+    tiff = args.mode != "all" and bigimage.is_tiff(outfile)
+
     # print("Image size:", isize)
-    if out_width > MAX_DIMENSION:
+    if out_width > MAX_DIMENSION and not tiff:
         sys.exit(
             "Output image is too wide: "
             + str(out_width)
             + " (Max: "
             + str(MAX_DIMENSION)
-            + "). Tip: avoid --greedy or use a smaller --thickness."
+            + "). Tip: avoid --greedy, use a smaller --thickness or "
+            "save as .tif."
         )
-    if out_height > MAX_DIMENSION:
+    if out_height > MAX_DIMENSION and not tiff:
         sys.exit(
             "Output image is too high: "
             + str(out_height)
             + " (Max: "
             + str(MAX_DIMENSION)
-            + "). Tip: avoid --greedy or use a smaller --thickness."
+            + "). Tip: avoid --greedy, use a smaller --thickness or "
+            "save as .tif."
         )
 
     if args.mode == "fixed":
@@ -119,14 +523,28 @@ def make_image(files):
             )
             lower = upper + slice_thickness
 
-    if args.mode == "all" and args.keepfree:
+    if args.mode == "all" and args.engine == "stack":
+        make_all_images_in_one_pass(files, vertical, slice_thickness, number_of_slices)
+        return
+
+    cache = None
+    if args.mode == "all":
         loops = number_of_slices
-        from psutil import virtual_memory  # for caching
+        if args.cache_mb:
+            cache = SliceCache(args.cache_mb * 1024 * 1024, vertical)
     else:
         loops = 1
 
-    img_cache = []
-    cache_full = False
+    writer = None
+    if args.video and not plan_only:
+        writer = videoutils.FrameWriter(args.video, args.framerate)
+
+    if args.jobs > 1 and not cache and not plan_only:
+        print("Workers:\t", args.jobs)
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+    else:
+        executor = None
+
     for j in range(loops):
         print("Creating:\t" + str(j + 1) + "/" + str(loops))
         if args.mode == "all":
@@ -138,19 +556,22 @@ def make_image(files):
                 lower = upper + slice_thickness
             outfile = args.outfile + "-" + str(j).zfill(6) + ".jpg"
 
-        if os.path.exists(outfile):
+        if os.path.exists(outfile) and not writer:
             print("File exists, skipping:", outfile)
             continue
 
         # Create the new image. The background doesn't have to be white
         white = (255, 255, 255)
-        inew = Image.new("RGB", (out_width, out_height), white)
+        if tiff:
+            inew = bigimage.TiffCanvas(outfile, (out_width, out_height), white)
+        else:
+            inew = Image.new("RGB", (out_width, out_height), white)
 
         if args.mode != "eiriksmagick":
             crop_bbox = (int(left), int(upper), int(right), int(lower))
 
+        slices = []
         for i, filename in enumerate(files):
-            sys.stdout.write("\rProcessing file " + str(i + 1) + "/" + str(len(files)))
             if vertical:
                 left = i * slice_thickness
                 right = left + slice_thickness
@@ -164,39 +585,48 @@ def make_image(files):
             # try:
             # # Read in an image and resize appropriately
 
-            # TODO when caching
-            # 1. chop image, and only keep remainder in cache
-            # 2. can then add more stuff to cache
-
             if (crop_bbox[2] > in_width) or (crop_bbox[3] > in_height):
                 # Don't if crop_box is outside the image
                 continue
+            slices.append((i, filename, crop_bbox, paste_bbox))
+
+        if plan_only:
+            return outfile, inew, slices
+
+        if cache:
+            imgs = (cache.crop(i, filename, box) for i, filename, box, _ in slices)
+        elif executor:
+            # Decoded and cropped in parallel, but returned in order
+            imgs = executor.map(
+                crop_file,
+                [filename for _, filename, _, _ in slices],
+                [box for _, _, box, _ in slices],
+                chunksize=max(1, len(slices) // (args.jobs * 4)),
+            )
+        else:
+            imgs = (crop_file(filename, box) for _, filename, box, _ in slices)
 
-            if args.mode == "all" and args.keepfree and not cache_full:
-                free_megabytes = virtual_memory().free / (1024 * 1024)
-                if free_megabytes < args.keepfree:
-                    cache_full = True
-
-            if len(img_cache) > i:
-                # print("load from cache")
-                img = img_cache[i].crop(crop_bbox)
-            elif loops > 1 and not cache_full:
-                # print("add to cache")
-                img_cache.append(Image.open(filename))
-                # img = img.crop(crop_bbox)
-                img = img_cache[i].crop(crop_bbox)
-            else:
-                # print("don't use cache")
-                img = Image.open(filename).crop(crop_bbox)
-
+        for img, (i, filename, crop_bbox, paste_bbox) in zip(imgs, slices):
+            sys.stdout.write("\rProcessing file " + str(i + 1) + "/" + str(len(files)))
             # except:
             # break
             inew.paste(img, paste_bbox)
             # count += 1
         sys.stdout.write("\r\n")
 
-        print("Saving to", outfile)
-        inew.save(outfile, quality=95)
+        if writer:
+            writer.put(numpy.asarray(inew))
+        else:
+            print("Saving to", outfile)
+            inew.save(outfile, quality=95)
+
+    if writer:
+        print("Video frames:\t", writer.close())
+    if executor:
+        executor.shutdown()
+    if cache:
+        cache.report()
+    region_reader.report()
 
 
 if __name__ == "__main__":
@@ -204,7 +634,12 @@ if __name__ == "__main__":
         description="Slice input files into an output file. Requires PIL.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    parser.add_argument("-i", "--inspec", default="*.jpg", help="Input file spec")
+    parser.add_argument(
+        "-i",
+        "--inspec",
+        default="*.jpg",
+        help="Input file spec, or a video file for --mode rolling",
+    )
     parser.add_argument(
         "-v", "--reverse", action="store_true", help="Reverse list of input files"
     )
@@ -213,20 +648,46 @@ if __name__ == "__main__":
         "-m",
         "--mode",
         default="eiriksmagick",
-        choices=("eiriksmagick", "fixed", "all"),
+        choices=("eiriksmagick", "fixed", "all", "rolling", "map"),
         help="How to slice images. 'fixed' takes slices from a fixed position "
         "in each image (e.g. the centre), 'eiriksmagick' takes a different "
         "slice from each, moving from left to right (or top to bottom). "
         "Both create a single image. 'all' makes lots of image, each with "
-        "slices from the same place.",
+        "slices from the same place. 'rolling' makes an image for each input, "
+        "from fixed slices of the last --window inputs. 'map' makes one "
+        "image with a slit of --geometry.",
+    )
+    parser.add_argument(
+        "--geometry",
+        default="diagonal",
+        choices=("diagonal", "radial", "angular", "wave"),
+        help="For --mode map: The shape of the slit. 'diagonal' sweeps from "
+        "top left to bottom right, 'radial' out from the centre, 'angular' "
+        "round the centre and 'wave' left to right with a wavy slit.",
     )
     parser.add_argument(
         "-p",
         "--fixedposition",
         type=int,
         default=50,
-        help="When using `--mode fixed`, this is the percentage "
-        "across the image to take slice.",
+        help="When using `--mode fixed` or `--mode rolling`, this is the "
+        "percentage across the image to take slice.",
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        help="For --mode rolling: How many inputs make each output. "
+        "Default is enough to make the output the same size as the input.",
+    )
+    parser.add_argument(
+        "--video",
+        metavar="VIDEO_FILE",
+        help="For --mode all and rolling: Pipe the outputs straight into ffmpeg "
+        "to make this video, instead of saving an image sequence",
+    )
+    parser.add_argument(
+        "-r", "--framerate", metavar="fps", default=25, type=int, help="For --video"
     )
     parser.add_argument(
         "-d",
@@ -255,10 +716,28 @@ if __name__ == "__main__":
         "Uses default filenames.",
     )
     parser.add_argument(
-        "-kf",
-        "--keepfree",
+        "--engine",
+        default="stack",
+        choices=("stack", "reread"),
+        help="For --mode all: 'stack' decodes each input image once, holding "
+        "the slices for every output in a temp file as big as the outputs "
+        "uncompressed. 'reread' re-opens every input image for each output, "
+        "which is much slower but needs no temp space.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
         type=int,
-        help="Cache but keep this much MB free when initially filling cache.",
+        default=1,
+        help="Number of worker processes decoding and cropping images in "
+        "parallel. Use 0 for all CPUs. Not for --mode all with --engine stack "
+        "or --cache-mb.",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        help="For --engine reread: Keep up to this many MB of decoded images "
+        "in memory between outputs, only the parts still to be sliced.",
     )
     args = parser.parse_args()
 
@@ -270,18 +749,33 @@ if __name__ == "__main__":
     except ImportError:
         pass
     print(args)
+    if args.jobs == 0:
+        args.jobs = os.cpu_count()
 
-    files = glob.glob(args.inspec)
-    sanity_check(files)
-    if args.reverse:
-        files = files[::-1]
-    if not args.supercombo:
+    if videoutils.is_video(args.inspec):
+        if args.mode != "rolling":
+            sys.exit("Video input only works with --mode rolling")
+        files = None
+    else:
+        files = glob.glob(args.inspec)
+        sanity_check(files)
+        if args.reverse:
+            files = files[::-1]
+    if args.mode == "rolling":
+        make_rolling_slitscan(files)
+    elif args.mode == "map":
+        make_mapped_image(files)
+    elif not args.supercombo:
         make_image(files)
     else:  # Super Combo!
+        plans = []
         for args.mode in "eiriksmagick", "fixed":
             for args.direction in "horizontal", "vertical":
                 for args.greedy in True, False:
                     args.outfile = None
-                    make_image(files)
+                    plan = make_image(files, plan_only=True)
+                    if plan:
+                        plans.append(plan)
+        make_images_together(plans, files)
 
 # End of file
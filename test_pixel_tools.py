@@ -34,7 +34,7 @@ class TestPixelTools(unittest.TestCase):
         if include_outfile:
             cmd += " -o " + self.outfile
         print(cmd)
-        os.system(cmd)
+        return os.system(cmd)
 
     def setUp(self):
         self.inspec = '"111*.jpg"'
@@ -48,6 +48,34 @@ class TestPixelTools(unittest.TestCase):
         self.outfile = f"out_{cmd}.{extension}"
         self.assert_deleted(self.outfile)
 
+    def test_align_estimate_offsets(self):
+        """Check a shifted copy of an image is found to be shifted back"""
+        # Arrange
+        from PIL import Image
+
+        import align
+
+        reference = "out_align_reference.png"
+        moved = "out_align_moved.png"
+        cache_file = "out_align.json"
+        self.assert_deleted(cache_file)
+        with Image.open(self.infile) as im:
+            im = im.convert("RGB")
+            im.save(reference)
+            im.rotate(0, translate=(7, -4)).save(moved)
+
+        # Act
+        offsets = align.estimate_offsets(
+            [reference, moved], reference, cache_file=cache_file
+        )
+
+        # Assert
+        dx, dy, angle = offsets[moved]
+        self.assertAlmostEqual(dx, -7, delta=1)
+        self.assertAlmostEqual(dy, 4, delta=1)
+        self.assertEqual(angle, 0)
+        self.assertTrue(os.path.isfile(cache_file))
+
     @pytest.mark.skipif(sys.platform == "linux", reason="No Helvetica font")
     def test_annotate(self):
         """Just test with some options and check an output file is created"""
@@ -63,6 +91,59 @@ class TestPixelTools(unittest.TestCase):
         self.assertTrue(os.path.isfile(self.outfile))
         self.assertNotEqual(os.path.getsize(self.infile), os.path.getsize(self.outfile))
 
+    def test_bigimage_create_tiff_memmap(self):
+        """Check a memory-mapped TIFF can be filled and read back"""
+        # Arrange
+        import numpy
+        from PIL import Image
+
+        import bigimage
+        import region_reader
+
+        outfile = "out_bigimage.tif"
+        self.assert_deleted(outfile)
+        rng = numpy.random.default_rng(0)
+        pixels = rng.integers(0, 256, size=(50, 37, 3), dtype=numpy.uint8)
+
+        # Act
+        out = bigimage.create_tiff_memmap(outfile, 37, 50)
+        out[:] = pixels
+        out.flush()
+        del out
+
+        # Assert
+        with Image.open(outfile) as im:
+            numpy.testing.assert_array_equal(numpy.asarray(im), pixels)
+        region = region_reader.read_region(outfile, (5, 10, 30, 45))
+        numpy.testing.assert_array_equal(region, pixels[10:45, 5:30])
+
+    def test_bigimage_streaming_canvas(self):
+        """Check pasting down a streamed PNG or TIFF makes the same image"""
+        # Arrange
+        from PIL import Image
+
+        import bigimage
+
+        with Image.open(self.infile) as im:
+            im = im.convert("RGB")
+        boxes = [(3, 2), (200, 2), (10, 290), (50, 600)]
+        expected = Image.new("RGB", (700, 950), "teal")
+        for box in boxes:
+            expected.paste(im, box)
+
+        for outfile in ("out_bigimage_stream.png", "out_bigimage_stream.tif"):
+            self.assert_deleted(outfile)
+
+            # Act
+            canvas = bigimage.StreamingCanvas(outfile, expected.size, "teal")
+            for box in boxes:
+                canvas.paste(im, box)
+            canvas.save(outfile)
+
+            # Assert
+            with Image.open(outfile) as actual:
+                self.assertEqual(actual.tobytes(), expected.tobytes())
+
     def test_blockit(self):
         """Just test with some options and check an output file is created"""
         # Arrange
@@ -102,6 +183,165 @@ class TestPixelTools(unittest.TestCase):
         # Assert
         self.assertTrue(os.path.isfile(self.outfile))
 
+    def test_contact_sheet_bigger_than_jpeg(self):
+        """Check a TIFF contact sheet can be wider than JPEG allows"""
+        # Arrange
+        from PIL import Image
+
+        cmd = "contact_sheet.py"
+        args = " -i " + self.inspec + " -c 2 -r 1 --thumbsize 33000x2"
+        self.helper_set_up(cmd, "tif")
+
+        # Act
+        self.run_cmd(cmd, args)
+
+        # Assert
+        with Image.open(self.outfile) as im:
+            self.assertEqual(im.size, (2 * 33000 + 5 + 5 + 1, 2 + 5 + 5))
+
+    def test_contact_sheet_jobs(self):
+        """Check a bad file only leaves its own cell empty with --jobs"""
+        # Arrange
+        from PIL import Image
+
+        import contact_sheet
+
+        fnames = []
+        for i in range(4):
+            filename = f"out_contact_sheet_jobs{i}.png"
+            Image.new("RGB", (8, 8), (0, i * 50, 0)).save(filename)
+            fnames.append(filename)
+        with open(fnames[1], "w") as f:
+            f.write("Not an image")
+
+        # Act
+        inew = contact_sheet.make_contact_sheet(
+            fnames, (4, 1), (4, 4), (0, 0, 0, 0), 0, jobs=2
+        )
+
+        # Assert
+        self.assertEqual(inew.getpixel((0, 0)), (0, 0, 0))
+        self.assertEqual(inew.getpixel((4, 0)), (255, 255, 255))
+        self.assertEqual(inew.getpixel((8, 0)), (0, 100, 0))
+        self.assertEqual(inew.getpixel((12, 0)), (0, 150, 0))
+
+    def test_contact_sheet_thumbnail_cache(self):
+        """Check a rebuild only reads cached thumbnails, and old ones go first"""
+        # Arrange
+        import io
+        import shutil
+
+        from PIL import Image
+
+        import contact_sheet
+
+        shutil.rmtree("out_contact_sheet_cache", ignore_errors=True)
+        fnames = []
+        sizes = []
+        for i in range(3):
+            filename = f"out_contact_sheet_cache{i}.png"
+            Image.new("RGB", (8, 8), (i * 50, 0, 0)).save(filename)
+            fnames.append(filename)
+            png = io.BytesIO()
+            Image.new("RGB", (4, 4), (i * 50, 0, 0)).save(png, "PNG")
+            sizes.append(len(png.getvalue()))
+        # Room for two 4x4 thumbnails
+        cache = contact_sheet.ThumbnailCache("out_contact_sheet_cache", 2 * max(sizes))
+        first = contact_sheet.make_contact_sheet(
+            fnames, (3, 1), (4, 4), (0, 0, 0, 0), 0, cache=cache
+        )
+        # Evicted as the third was written, not at the end
+        paths, hits = cache.lookup(fnames, (4, 4))
+        self.assertEqual(hits, [False, True, True])
+
+        # Act
+        second = contact_sheet.make_contact_sheet(
+            fnames[:2], (2, 1), (4, 4), (1, 1, 1, 1), 1, "black", cache=cache
+        )
+
+        # Assert
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        self.assertEqual(
+            second.crop((1, 1, 5, 5)).tobytes(), first.crop((0, 0, 4, 4)).tobytes()
+        )
+        # The oldest, apart from the one still to be read
+        paths, hits = cache.lookup(fnames, (4, 4))
+        self.assertEqual(hits, [True, True, False])
+        self.assertLessEqual(cache.total, cache.max_bytes)
+
+    def test_contact_sheet_deep_zoom(self):
+        """Check a Deep Zoom pyramid is made, then only remade where changed"""
+        # Arrange
+        import shutil
+
+        from PIL import Image
+
+        import contact_sheet
+
+        shutil.rmtree("out_contact_sheet_files", ignore_errors=True)
+        outfile = "out_contact_sheet.dzi"
+        fnames = []
+        for i in range(4):
+            filename = f"out_contact_sheet_dzi{i}.png"
+            Image.new("RGB", (20, 20), (0, 0, i * 50)).save(filename)
+            fnames.append(filename)
+        inew = contact_sheet.make_contact_sheet(
+            fnames, (2, 2), (200, 200), (0, 0, 0, 0), 0, outfile=outfile
+        )
+        inew.save(outfile)
+        # Not remade, so still from 1970
+        os.utime("out_contact_sheet_files/9/1_1.jpg", ns=(0, 0))
+        Image.new("RGB", (20, 20), "red").save(fnames[0])
+        # Changed even if saved within the same clock tick
+        os.utime(fnames[0], ns=(0, 0))
+
+        # Act
+        inew = contact_sheet.make_contact_sheet(
+            fnames, (2, 2), (200, 200), (0, 0, 0, 0), 0, outfile=outfile
+        )
+        inew.save(outfile)
+
+        # Assert
+        self.assertEqual(os.stat("out_contact_sheet_files/9/1_1.jpg").st_mtime, 0)
+        with Image.open("out_contact_sheet_files/9/0_0.jpg") as im:
+            self.assertEqual(im.size, (256, 256))
+            self.assertGreater(im.getpixel((100, 100))[0], 200)
+        with Image.open("out_contact_sheet_files/9/1_0.jpg") as im:
+            self.assertEqual(im.size, (144, 256))
+        # 400x400 is 9 halvings from 1x1, so levels 0 to 9
+        with Image.open("out_contact_sheet_files/0/0_0.jpg") as im:
+            self.assertEqual(im.size, (1, 1))
+
+    def test_deepzoom_interrupted(self):
+        """Check tiles rewritten by an interrupted run are remade next time"""
+        # Arrange
+        import shutil
+
+        from PIL import Image
+
+        import deepzoom
+
+        shutil.rmtree("out_deepzoom_files", ignore_errors=True)
+        outfile = "out_deepzoom.dzi"
+        boxes = [(0, 0, 20, 300), (0, 300, 20, 600)]
+        red = Image.new("RGB", (20, 300), "red")
+        blue = Image.new("RGB", (20, 300), "blue")
+        pyramid = deepzoom.Pyramid(outfile, (20, 600), "white", boxes, ["a", "b"])
+        pyramid.paste(red, boxes[0])
+        pyramid.paste(red, boxes[1])
+        pyramid.save(outfile)
+        # Pasting the second writes the first row of tiles, then it stops
+        pyramid = deepzoom.Pyramid(outfile, (20, 600), "white", boxes, ["c", "d"])
+        pyramid.paste(blue, boxes[0])
+        pyramid.paste(blue, boxes[1])
+
+        # Act
+        pyramid = deepzoom.Pyramid(outfile, (20, 600), "white", boxes, ["a", "b"])
+
+        # Assert
+        self.assertTrue(pyramid.needed(boxes[0]))
+        self.assertTrue(pyramid.needed(boxes[1]))
+
     def test_deframify(self):
         """Just test with some options and check an output file is created"""
         # Arrange
@@ -251,6 +491,386 @@ class TestPixelTools(unittest.TestCase):
         # Assert
         self.assertTrue(os.path.isfile(self.outfile))
 
+    def test_pixelator_numpy(self):
+        """Just test with some options and check an output file is created"""
+        # Arrange
+        cmd = "pixelator.py"
+        args = " -i " + self.inspec + " --engine numpy"
+        self.helper_set_up(cmd)
+
+        # Act
+        self.run_cmd(cmd, args)
+
+        # Assert
+        self.assertTrue(os.path.isfile(self.outfile))
+
+    def test_pixelator_sum_frames(self):
+        """Check the accumulator matches a plain mean"""
+        # Arrange
+        import glob
+
+        import numpy
+
+        import pixelator
+
+        files = glob.glob(self.inspec.strip('"'))
+        frames = [pixelator.load_frame(f) for f in files]
+
+        # Act
+        total, count = pixelator.sum_frames(files)
+        average = pixelator.average_from_sum(total, count)
+
+        # Assert
+        self.assertEqual(count, len(files))
+        expected = numpy.mean(frames, axis=0)
+        self.assertLessEqual(numpy.abs(average - expected).max(), 0.5)
+
+    def test_pixelator_sum_frames_in_parallel(self):
+        """Check parallel partial sums add up to the serial sum"""
+        # Arrange
+        import glob
+
+        import numpy
+
+        import pixelator
+
+        files = glob.glob(self.inspec.strip('"'))
+        expected_total, expected_count = pixelator.sum_frames(files)
+
+        # Act
+        total, count = pixelator.sum_frames_in_parallel(files, jobs=2, batch_size=4)
+
+        # Assert
+        self.assertEqual(count, expected_count)
+        numpy.testing.assert_array_equal(total, expected_total)
+
+    def test_pixelator_sum_frames_in_parallel_memory(self):
+        """Check the parent doesn't keep every batch's partial sum"""
+        # Arrange
+        import tracemalloc
+
+        from PIL import Image
+
+        import pixelator
+
+        with Image.open(self.infile) as im:
+            im = im.convert("RGB")
+        files = []
+        for i in range(40):
+            filename = f"out_pixelator_memory{i}.png"
+            im.save(filename)
+            files.append(filename)
+        accumulator_bytes = im.width * im.height * 3 * 4
+
+        # Act
+        tracemalloc.start()
+        total, count = pixelator.sum_frames_in_parallel(files, jobs=2, batch_size=1)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # Assert
+        self.assertEqual(count, 40)
+        # The total, and a few partial sums in flight, rather than all 40
+        self.assertLess(peak, 10 * accumulator_bytes)
+
+    def test_pixelator_pick_random_pixels(self):
+        """Check every output pixel comes from one of the inputs"""
+        # Arrange
+        import glob
+
+        import numpy
+
+        import pixelator
+
+        files = glob.glob(self.inspec.strip('"'))
+        frames = numpy.stack([pixelator.load_frame(f) for f in files])
+
+        # Act
+        out = pixelator.pick_random_pixels(files, numpy.random.default_rng(0))
+
+        # Assert
+        self.assertEqual(out.shape, frames.shape[1:])
+        matches = (frames == out).all(axis=3).any(axis=0)
+        self.assertTrue(matches.all())
+
+    def test_pixelator_merge_states(self):
+        """Check saved states of disjoint images merge to the full sum"""
+        # Arrange
+        import glob
+
+        import numpy
+
+        import pixelator
+
+        files = sorted(glob.glob(self.inspec.strip('"')))
+        halves = files[:2], files[2:]
+        state_files = ["out_pixelator_state1.npz", "out_pixelator_state2.npz"]
+        for half, state_file in zip(halves, state_files):
+            self.assert_deleted(state_file)
+            total, count = pixelator.sum_frames(half)
+            pixelator.save_state(state_file, total, count, half)
+        expected_total, expected_count = pixelator.sum_frames(files)
+
+        # Act
+        total, count, done = pixelator.merge_states(state_files)
+
+        # Assert
+        self.assertEqual(count, expected_count)
+        self.assertEqual(done, set(files))
+        numpy.testing.assert_array_equal(total, expected_total)
+        with self.assertRaises(SystemExit):
+            pixelator.merge_states([state_files[0], state_files[0]])
+
+    def test_pixelator_median(self):
+        """Just test with some options and check an output file is created"""
+        # Arrange
+        cmd = "pixelator.py"
+        args = " -i " + self.inspec + " -e median --max-memory 1"
+        self.helper_set_up(cmd)
+
+        # Act
+        self.run_cmd(cmd, args)
+
+        # Assert
+        self.assertTrue(os.path.isfile(self.outfile))
+
+    def test_pixelator_percentile_refused(self):
+        """Check a bad percentile or too little disk is found before any work"""
+        # Arrange
+        import shutil
+
+        import numpy
+
+        import pixelator
+
+        cmd = "pixelator.py"
+        args = " -i " + self.inspec + " -e percentile -p 150"
+        self.helper_set_up(cmd)
+        temp_dir = "out_pixelator_spill"
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.mkdir(temp_dir)
+        frames = iter([numpy.zeros((1000, 1000, 3), numpy.uint8)])
+
+        # Act
+        self.run_cmd(cmd, args)
+
+        # Assert
+        self.assertFalse(os.path.isfile(self.outfile))
+        with self.assertRaises(SystemExit):
+            # A petabyte
+            pixelator.spill_frames(frames, temp_dir, expected=10**9)
+        self.assertEqual(os.path.getsize(os.path.join(temp_dir, "frames.raw")), 0)
+
+    def test_pixelator_percentile_composite(self):
+        """Check banding gives the same result as one big percentile"""
+        # Arrange
+        import numpy
+
+        import pixelator
+
+        rng = numpy.random.default_rng(0)
+        stack = rng.integers(0, 256, size=(7, 50, 40, 3), dtype=numpy.uint8)
+
+        # Act
+        median = pixelator.percentile_composite(stack, 50, max_memory=10_000)
+        p90 = pixelator.percentile_composite(stack, 90, max_memory=10_000)
+
+        # Assert
+        numpy.testing.assert_array_equal(
+            median, numpy.rint(numpy.median(stack, axis=0))
+        )
+        numpy.testing.assert_array_equal(
+            p90, numpy.rint(numpy.percentile(stack, 90, axis=0))
+        )
+
+    def test_pixelator_tiled(self):
+        """Check the tiled average matches the average of the whole images"""
+        # Arrange
+        import glob
+
+        import numpy
+        from PIL import Image
+
+        import pixelator
+
+        cmd = "pixelator.py"
+        # More tiles across than are made at once
+        args = " -i " + self.inspec + " --tile-size 40"
+        self.helper_set_up(cmd, extension="tif")
+        files = glob.glob(self.inspec.strip('"'))
+        expected = pixelator.average_from_sum(*pixelator.sum_frames(files))
+
+        # Act
+        self.run_cmd(cmd, args)
+
+        # Assert
+        with Image.open(self.outfile) as im:
+            numpy.testing.assert_array_equal(numpy.asarray(im), expected)
+
+    def test_pixelator_tiled_refused(self):
+        """Check --tile-size refuses options it can't use, before any work"""
+        # Arrange
+        cmd = "pixelator.py"
+        args = [
+            " -i " + self.inspec + " --tile-size 100",
+            " -i " + self.inspec + " --tile-size 100 --jobs 2",
+            " -i " + self.inspec + " --tile-size 100 -e median",
+        ]
+        extensions = ["jpg", "tif", "tif"]
+
+        for arg, extension in zip(args, extensions):
+            self.helper_set_up(cmd, extension=extension)
+
+            # Act
+            self.run_cmd(cmd, arg)
+
+            # Assert
+            self.assertFalse(os.path.isfile(self.outfile))
+
+    def test_pixelator_preview(self):
+        """Check the preview is made at reduced size"""
+        # Arrange
+        from PIL import Image
+
+        cmd = "pixelator.py"
+        args = " -i " + self.inspec + " --preview 4"
+        self.helper_set_up(cmd)
+        with Image.open(self.infile) as im:
+            width, height = im.size
+
+        # Act
+        self.run_cmd(cmd, args)
+
+        # Assert
+        with Image.open(self.outfile) as im:
+            self.assertEqual(im.size, (width // 4, height // 4))
+
+    def test_pixelator_moving_averages(self):
+        """Check the running sum matches averaging each window afresh"""
+        # Arrange
+        import numpy
+
+        import pixelator
+
+        rng = numpy.random.default_rng(0)
+        frames = rng.integers(0, 256, size=(9, 4, 5, 3), dtype=numpy.uint8)
+        window = 4
+
+        # Act
+        averages = list(pixelator.moving_averages(iter(frames), window))
+
+        # Assert
+        self.assertEqual(len(averages), len(frames) - window + 1)
+        for k, average in enumerate(averages):
+            total = frames[k : k + window].sum(axis=0, dtype=numpy.uint32)
+            expected = pixelator.average_from_sum(total, window)
+            numpy.testing.assert_array_equal(average, expected)
+
+    def test_pixelator_extreme_image_no_frames(self):
+        """Check no frames is an error, not a crash"""
+        # Arrange
+        import pixelator
+
+        pixelator.args = argparse.Namespace(outfile="out_pixelator_extreme.jpg")
+
+        # Act
+        with self.assertRaises(SystemExit) as cm:
+            pixelator.create_extreme_image(iter([]))
+
+        # Assert
+        self.assertEqual(cm.exception.code, "No frames")
+
+    def test_pixelator_window_refused(self):
+        """Check a window of zero or longer than the input makes nothing"""
+        # Arrange
+        import glob
+
+        cmd = "pixelator.py"
+        self.helper_set_up(cmd)
+        for filename in glob.glob("out_pixelator.py-*.jpg"):
+            os.remove(filename)
+
+        for window in (0, -2, 1000):
+            args = " -i " + self.inspec + " --engine numpy --window " + str(window)
+
+            # Act
+            status = self.run_cmd(cmd, args)
+
+            # Assert
+            self.assertNotEqual(status, 0)
+            self.assertEqual(glob.glob("out_pixelator.py-*.jpg"), [])
+            self.assertFalse(os.path.isfile(self.outfile))
+
+    def test_pixelator_running_extremes(self):
+        """Check lighten and darken match the maximum and minimum"""
+        # Arrange
+        import numpy
+
+        import pixelator
+
+        rng = numpy.random.default_rng(0)
+        frames = rng.integers(0, 256, size=(6, 4, 5, 3), dtype=numpy.uint8)
+
+        # Act
+        lighten = [
+            c.copy() for c in pixelator.running_extremes(iter(frames), lighten=True)
+        ]
+        darken = [
+            c.copy() for c in pixelator.running_extremes(iter(frames), lighten=False)
+        ]
+
+        # Assert
+        for i in range(len(frames)):
+            numpy.testing.assert_array_equal(lighten[i], frames[: i + 1].max(axis=0))
+            numpy.testing.assert_array_equal(darken[i], frames[: i + 1].min(axis=0))
+
+    def test_pixelator_video(self):
+        """Check a video can be used as input"""
+        # Arrange
+        video = "out_pixelator_video.mp4"
+        self.assert_deleted(video)
+        os.system(
+            "ffmpeg -f image2 -pattern_type glob -i "
+            + self.inspec.replace('"', "'")
+            + " -c:v libx264 -pix_fmt yuv420p "
+            + video
+        )
+        cmd = "pixelator.py"
+        args = " -i " + video + " -e lighten --nth 2"
+        self.helper_set_up(cmd)
+
+        # Act
+        self.run_cmd(cmd, args)
+
+        # Assert
+        self.assertTrue(os.path.isfile(self.outfile))
+
+    def test_pixelator_preview_video(self):
+        """Check a preview of a video estimates the full run"""
+        # Arrange
+        import contextlib
+        import io
+
+        import pixelator
+
+        video = "out_pixelator_preview_video.mp4"
+        self.assert_deleted(video)
+        os.system(
+            "ffmpeg -f image2 -pattern_type glob -i "
+            + self.inspec.replace('"', "'")
+            + " -c:v libx264 -pix_fmt yuv420p "
+            + video
+        )
+        pixelator.args = argparse.Namespace(start=None, duration=None, nth=None)
+        output = io.StringIO()
+
+        # Act
+        with contextlib.redirect_stdout(output):
+            pixelator.report_preview(video, 1.0, 4)
+
+        # Assert
+        self.assertIn("Full run estimate:", output.getvalue())
+
     def test_pixelator_random(self):
         """Just test with some options and check an output file is created"""
         # Arrange
@@ -264,6 +884,54 @@ class TestPixelTools(unittest.TestCase):
         # Assert
         self.assertTrue(os.path.isfile(self.outfile))
 
+    def test_region_reader_read_regions(self):
+        """Check regions match cropping, decoding only down to the lowest"""
+        # Arrange
+        import numpy
+        from PIL import Image
+
+        import region_reader
+
+        with Image.open(self.infile) as im:
+            width, height = im.size
+            im = im.convert("RGB")
+        boxes = [(0, 0, 10, 10), (20, 5, 21, 30), (-5, 25, 5, 35)]
+        region_reader.stats.update(decoded=0, kept=0)
+
+        # Act
+        regions = region_reader.read_regions(self.infile, boxes)
+
+        # Assert
+        for box, region in zip(boxes, regions):
+            numpy.testing.assert_array_equal(region, numpy.asarray(im.crop(box)))
+        self.assertEqual(region_reader.stats["decoded"], width * 35 * 3)
+        self.assertEqual(region_reader.stats["kept"], (100 + 25 + 100) * 3)
+
+    def test_region_reader_truncated(self):
+        """Check a truncated file is an error only below where its data ends"""
+        # Arrange
+        import numpy
+        from PIL import Image
+
+        import region_reader
+
+        cut = "out_region_reader_cut.jpg"
+        with open(self.infile, "rb") as f:
+            data = f.read()
+        with open(cut, "wb") as f:
+            f.write(data[: len(data) // 3])
+        with Image.open(self.infile) as im:
+            width, height = im.size
+            im = im.convert("RGB")
+
+        # Act
+        region = region_reader.read_region(cut, (0, 0, 10, 10))
+
+        # Assert
+        numpy.testing.assert_array_equal(region, numpy.asarray(im.crop((0, 0, 10, 10))))
+        with self.assertRaises(OSError):
+            region_reader.read_region(cut, (0, height - 10, 10, height))
+
     def test_slitscan(self):
         """Just test with some options and check an output file is created"""
         # Arrange
@@ -289,3 +957,207 @@ class TestPixelTools(unittest.TestCase):
         # Assert
         for file in filelist:
             self.assertTrue(os.path.isfile(file))
+
+    def test_slitscan_cut_slices(self):
+        """Check slices cut all at once match cropping each one"""
+        # Arrange
+        import numpy
+        from PIL import Image
+
+        import slitscan
+
+        rng = numpy.random.default_rng(0)
+        frame = rng.integers(0, 256, size=(8, 12, 3), dtype=numpy.uint8)
+        im = Image.fromarray(frame)
+        starts = slitscan.slice_starts(12, 12, 3)
+
+        # Act
+        vertical = slitscan.cut_slices(frame, starts, 3, vertical=True)
+        horizontal = slitscan.cut_slices(frame, starts[:6], 3, vertical=False)
+
+        # Assert
+        for j, start in enumerate(starts):
+            if start + 3 <= 12:
+                expected = numpy.asarray(im.crop((start, 0, start + 3, 8)))
+                numpy.testing.assert_array_equal(vertical[j], expected)
+        for j, start in enumerate(starts[:6]):
+            expected = numpy.asarray(im.crop((0, start, 12, start + 3)))
+            numpy.testing.assert_array_equal(horizontal[j], expected)
+
+    def test_slitscan_slice_cache(self):
+        """Check cached crops match cropping the image, and are counted"""
+        # Arrange
+        import numpy
+        from PIL import Image
+
+        import slitscan
+
+        with Image.open(self.infile) as im:
+            width, height = im.size
+            im = im.convert("RGB")
+        cache = slitscan.SliceCache(width * height * 3, vertical=True)
+        boxes = [(left, 0, left + 4, height) for left in range(-2, width - 4, 7)]
+
+        # Act
+        crops = [cache.crop(0, self.infile, box) for box in boxes]
+
+        # Assert
+        for box, crop in zip(boxes, crops):
+            numpy.testing.assert_array_equal(
+                numpy.asarray(crop), numpy.asarray(im.crop(box))
+            )
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, len(boxes) - 1)
+        self.assertLess(cache.bytes, width * height * 3 / 2)
+
+    def test_slitscan_jobs(self):
+        """Check slices cut in parallel are put together in order"""
+        # Arrange
+        cmd = "slitscan.py"
+        serial = "out_slitscan_serial.jpg"
+        self.assert_deleted(serial)
+        self.outfile = "out_slitscan_jobs.jpg"
+        self.assert_deleted(self.outfile)
+
+        # Act
+        self.run_cmd(cmd, "-i " + self.inspec + " -o " + serial, False)
+        self.run_cmd(cmd, "-i " + self.inspec + " --jobs 2")
+
+        # Assert
+        with open(serial, "rb") as f1, open(self.outfile, "rb") as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_slitscan_rolling_slitscans(self):
+        """Check each output is the slices of the last few inputs, in order"""
+        # Arrange
+        import numpy
+
+        import slitscan
+
+        rng = numpy.random.default_rng(0)
+        slices = rng.integers(0, 256, size=(9, 5, 2, 3), dtype=numpy.uint8)
+
+        # Act
+        vertical = [o.copy() for o in slitscan.rolling_slitscans(iter(slices), 4, True)]
+        horizontal = [
+            o.copy()
+            for o in slitscan.rolling_slitscans(
+                iter(slices.transpose(0, 2, 1, 3)), 4, False
+            )
+        ]
+
+        # Assert
+        self.assertEqual(len(vertical), 6)
+        for k in range(6):
+            expected = numpy.concatenate(slices[k : k + 4], axis=1)
+            numpy.testing.assert_array_equal(vertical[k], expected)
+            numpy.testing.assert_array_equal(horizontal[k], expected.transpose(1, 0, 2))
+
+    def test_slitscan_fill_from_map(self):
+        """Check each pixel comes from the frame the slit map says"""
+        # Arrange
+        import numpy
+        from PIL import Image
+
+        import slitscan
+
+        files = []
+        for i in range(5):
+            filename = f"out_slitscan_map{i}.png"
+            Image.new("RGB", (16, 9), (i * 50, 0, 0)).save(filename)
+            files.append(filename)
+        frame_map = slitscan.slit_map("radial", 16, 9, len(files))
+
+        # Act
+        out = slitscan.fill_from_map(files, frame_map)
+
+        # Assert
+        self.assertEqual(set(numpy.unique(frame_map)), set(range(5)))
+        numpy.testing.assert_array_equal(out[..., 0], frame_map * 50)
+
+    def test_thumbnails_resize(self):
+        """Check fast thumbnails are close to resizing from full size"""
+        # Arrange
+        from PIL import Image, ImageOps
+
+        import thumbnails
+
+        infile = "out_thumbnails.jpg"
+        with Image.open(self.infile) as im:
+            im.resize((1600, 1200), Image.Resampling.BICUBIC).save(infile)
+
+        for crop in (False, True):
+            with Image.open(infile) as im:
+                if crop:
+                    expected = ImageOps.fit(im, (90, 100), Image.Resampling.LANCZOS)
+                else:
+                    expected = im.resize((90, 100), Image.Resampling.LANCZOS)
+
+            # Act
+            with Image.open(infile) as im:
+                actual = thumbnails.resize(im, (90, 100), crop)
+                draft_size = im.size
+
+            # Assert
+            self.assertEqual(actual.size, (90, 100))
+            self.assertLess(draft_size, (1600, 1200))
+            self.assertLessEqual(
+                thumbnails.difference(expected, actual), thumbnails.TOLERANCE
+            )
+
+    def test_videoutils_frame_writer(self):
+        """Check frames put into the writer all come back out of the video"""
+        # Arrange
+        import numpy
+
+        import videoutils
+
+        video = "out_videoutils_frame_writer.mp4"
+        self.assert_deleted(video)
+        writer = videoutils.FrameWriter(video)
+
+        # Act
+        for i in range(10):
+            writer.put(numpy.full((9, 16, 3), i * 20, numpy.uint8))
+        count = writer.close()
+
+        # Assert
+        self.assertEqual(count, 10)
+        frames = list(videoutils.read_frames(video))
+        self.assertEqual(len(frames), 10)
+        self.assertEqual(frames[0].shape, (10, 16, 3))
+
+    def test_videoutils_write_frames_fails(self):
+        """Check ffmpeg stopping early raises its error, not a broken pipe"""
+        # Arrange
+        import subprocess
+
+        import numpy
+
+        import videoutils
+
+        frames = (numpy.zeros((480, 640, 3), numpy.uint8) for i in range(200))
+
+        # Act
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            videoutils.write_frames("out_no_such_directory/out.mp4", frames)
+
+        # Assert
+        self.assertNotEqual(cm.exception.returncode, 0)
+
+    def test_videoutils_read_frames_after_end(self):
+        """Check starting after the end of a video gives no frames"""
+        # Arrange
+        import numpy
+
+        import videoutils
+
+        video = "out_videoutils_after_end.mp4"
+        self.assert_deleted(video)
+        videoutils.write_frames(video, [numpy.zeros((8, 8, 3), numpy.uint8)] * 5)
+
+        # Act
+        frames = list(videoutils.read_frames(video, start=100))
+
+        # Assert
+        self.assertEqual(frames, [])
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Resize images down to thumbnails, fast.
+
+Thumbnails are often 10-50x smaller than their images, so rather than
+decoding every pixel and resizing from full size with LANCZOS:
+
+* JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale (Image.draft), the
+  smallest that is still at least REDUCING_GAP times the thumbnail.
+* The rest is done by Image.resize with reducing_gap, which first shrinks
+  by a whole factor with a box filter, then uses LANCZOS for the last
+  REDUCING_GAP times or less.
+
+The result differs from a LANCZOS resize from full size by at most TOLERANCE
+on average per channel (out of 255). Run this file on some images to time
+both ways and check how different they are.
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import sys
+import time
+
+import numpy
+from PIL import Image
+
+# Pillow's docs say 3.0 is "indistinguishable from fair resampling in most cases"
+REDUCING_GAP = 3.0
+
+# Mean absolute difference per channel from a full size LANCZOS resize
+TOLERANCE = 1.0
+
+
+def fit_box(in_size, size):
+    """
+    The largest box of in_size with the same aspect ratio as size, from the
+    middle, as cropped by ImageOps.fit
+
+    >>> fit_box((400, 300), (100, 100))
+    (50.0, 0.0, 350.0, 300.0)
+    """
+    in_width, in_height = in_size
+    ratio = size[0] / size[1]
+    if in_width / in_height > ratio:
+        width, height = in_height * ratio, in_height
+    else:
+        width, height = in_width, in_width / ratio
+    left = (in_width - width) / 2
+    upper = (in_height - height) / 2
+    return left, upper, left + width, upper + height
+
+
+def resize(im, size, crop=False, reducing_gap=REDUCING_GAP):
+    """
+    Resize an unloaded image to exactly size (w, h), like im.resize with
+    LANCZOS, or ImageOps.fit when crop is True.
+
+    im must be straight from Image.open for the JPEG decoder to skip pixels.
+    """
+    box = fit_box(im.size, size) if crop else (0, 0) + im.size
+    if reducing_gap:
+        # Scale so the box is still at least reducing_gap times the size
+        width, height = im.size
+        draft_size = (
+            int(width * size[0] * reducing_gap / (box[2] - box[0])),
+            int(height * size[1] * reducing_gap / (box[3] - box[1])),
+        )
+        im.draft(None, draft_size)
+        scale_x, scale_y = im.size[0] / width, im.size[1] / height
+        box = (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+    return im.resize(size, Image.Resampling.LANCZOS, box=box, reducing_gap=reducing_gap)
+
+
+def difference(im1, im2):
+    """Mean absolute difference per channel"""
+    a = numpy.asarray(im1.convert("RGB"), dtype=numpy.int16)
+    b = numpy.asarray(im2.convert("RGB"), dtype=numpy.int16)
+    return float(numpy.abs(a - b).mean())
+
+
+def benchmark(files, size, crop=False):
+    """Time full size and fast resizing, and check they're within TOLERANCE"""
+    slow = fast = worst = 0.0
+    for i, filename in enumerate(files):
+        sys.stdout.write("\rProcessing file " + str(i + 1) + "/" + str(len(files)))
+        start = time.perf_counter()
+        with Image.open(filename) as im:
+            expected = resize(im, size, crop, reducing_gap=None)
+        slow += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with Image.open(filename) as im:
+            actual = resize(im, size, crop)
+        fast += time.perf_counter() - start
+
+        worst = max(worst, difference(expected, actual))
+    sys.stdout.write("\r\n")
+
+    print("Full size:\t %.3f s per image" % (slow / len(files)))
+    print("Fast:\t\t %.3f s per image" % (fast / len(files)))
+    print("Speedup:\t %.1fx" % (slow / fast))
+    print("Worst difference:\t %.2f (tolerance: %.2f)" % (worst, TOLERANCE))
+    return worst <= TOLERANCE
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark fast thumbnailing against resizing from full size",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-i", "--inspec", default="*.jpg", help="Input file spec")
+    parser.add_argument(
+        "-t", "--thumbsize", default="300x200", help="Width x height of thumbnails"
+    )
+    parser.add_argument(
+        "-tn",
+        "--thumbnail",
+        action="store_true",
+        help="Crop to the thumbnail's aspect ratio instead of squashing",
+    )
+    args = parser.parse_args()
+    print(args)
+
+    files = sorted(glob.glob(args.inspec))
+    if len(files) == 0:
+        sys.exit("No input files found.")
+    size = tuple(int(x) for x in args.thumbsize.split("x"))
+
+    if not benchmark(files, size, args.thumbnail):
+        sys.exit("Fast thumbnails are too different")
+
+# End of file
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Read decoded video frames from, or write them to, an ffmpeg pipe, without
+going through images on disk.
+"""
+from __future__ import annotations
+
+import io
+import os
+import queue
+import subprocess
+import threading
+
+import numpy
+from PIL import Image
+
+VIDEO_EXTENSIONS = (
+    ".avi",
+    ".m4v",
+    ".mkv",
+    ".mov",
+    ".mp4",
+    ".mpeg",
+    ".mpg",
+    ".mts",
+    ".webm",
+    ".wmv",
+)
+
+
+def is_video(filename):
+    return (
+        os.path.isfile(filename)
+        and os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+    )
+
+
+def input_args(filename, start=None, duration=None, every=None, scale=1):
+    """ffmpeg arguments to decode the chosen frames.
+
+    Sampling happens in the decoder, so skipped frames never reach Python.
+
+    >>> input_args("in.mp4", start=10, every=3)
+    ['-ss', '10', '-i', 'in.mp4', '-vf', 'select=not(mod(n\\\\,3))', '-vsync', '0']
+    """
+    args = []
+    if start:
+        args += ["-ss", str(start)]
+    args += ["-i", filename]
+    if duration:
+        args += ["-t", str(duration)]
+    filters = []
+    if every and every > 1:
+        filters.append(r"select=not(mod(n\,%d))" % every)
+    if scale > 1:
+        filters.append("scale=trunc(iw/%d):trunc(ih/%d)" % (scale, scale))
+    if filters:
+        args += ["-vf", ",".join(filters)]
+    # Don't duplicate frames to fill the gaps left by select
+    args += ["-vsync", "0"]
+    return args
+
+
+def frame_size(filename, **kwargs):
+    # Decode the first chosen frame to find the size after any filters,
+    # or None if there isn't one, such as when starting after the end
+    cmd = ["ffmpeg", "-v", "error"] + input_args(filename, **kwargs)
+    cmd += ["-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-"]
+    data = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    if not data:
+        return None
+    with Image.open(io.BytesIO(data)) as im:
+        return im.size
+
+
+def read_frames(filename, start=None, duration=None, every=None, scale=1):
+    """Yield RGB frames of a video as (height, width, 3) arrays.
+
+    start       Seconds into the video to start from
+    duration    Seconds of video to read
+    every       Only read every Nth frame
+    scale       Reduce the frame size by this factor
+    """
+    kwargs = dict(start=start, duration=duration, every=every, scale=scale)
+    size = frame_size(filename, **kwargs)
+    if size is None:
+        return
+    width, height = size
+    print("Video frame size:", width, "x", height)
+
+    cmd = ["ffmpeg", "-v", "error"] + input_args(filename, **kwargs)
+    cmd += ["-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+    print(" ".join(cmd))
+    frame_bytes = width * height * 3
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    finished = False
+    try:
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                finished = True
+                break
+            yield numpy.frombuffer(data, numpy.uint8).reshape(height, width, 3)
+    finally:
+        process.stdout.close()
+        if not finished:
+            # Stopped reading early, so don't decode the rest
+            process.kill()
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def write_frames(filename, frames, framerate=25):
+    """Encode (height, width, 3) RGB arrays into a video through an ffmpeg pipe.
+
+    Frames are sent as raw RGB, so none are written to disk as images.
+    Returns the number of frames written.
+    """
+    process = None
+    count = 0
+    try:
+        for frame in frames:
+            if process is None:
+                height, width = frame.shape[:2]
+                cmd = ["ffmpeg", "-v", "error", "-y", "-f", "rawvideo"]
+                cmd += ["-pix_fmt", "rgb24", "-s", "%dx%d" % (width, height)]
+                cmd += ["-r", str(framerate), "-i", "-"]
+                # H.264 in yuv420p needs even dimensions
+                cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+                cmd += ["-c:v", "libx264", "-pix_fmt", "yuv420p", filename]
+                print(" ".join(cmd))
+                process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            try:
+                process.stdin.write(numpy.ascontiguousarray(frame).tobytes())
+            except BrokenPipeError:
+                # ffmpeg has stopped, its exit status says why
+                break
+            count += 1
+    finally:
+        if process is not None:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+    if process is not None and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return count
+
+
+class FrameWriter:
+    """Encode frames into a video from a background thread.
+
+    put() hands a frame to the thread and returns straight away (unless
+    queue_size frames are already waiting), so the next frame can be made
+    while ffmpeg encodes. Don't change a frame after putting it.
+    """
+
+    def __init__(self, filename, framerate=25, queue_size=8):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.count = 0
+        self.error = None
+        self.finished = False
+        self.thread = threading.Thread(
+            target=self.run, args=(filename, framerate), daemon=True
+        )
+        self.thread.start()
+
+    def frames(self):
+        # Until close()
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                self.finished = True
+                return
+            yield frame
+
+    def run(self, filename, framerate):
+        try:
+            self.count = write_frames(filename, self.frames(), framerate)
+        except Exception as e:
+            self.error = e
+            if not self.finished:
+                # Keep taking frames so put() doesn't block forever
+                for frame in self.frames():
+                    pass
+
+    def put(self, frame):
+        self.queue.put(frame)
+
+    def close(self):
+        """Wait for the encoding to finish. Returns the number of frames."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.count
+
+
+# End of file